@@ -15,11 +15,13 @@ import matplotlib.pyplot as plt
 import pickle
 import glob
 import os
+import hashlib
+import multiprocessing as mp
 
 from google.colab.patches import cv2_imshow
 from google.colab import drive
 
-from collections import Counter
+from collections import Counter, deque
 import numpy as np
 from PIL import Image
 import itertools
@@ -37,6 +39,7 @@ import torch
 from torch.utils.data import Dataset, DataLoader, random_split, ConcatDataset, ChainDataset, IterableDataset
 from torch.utils.data.sampler import Sampler, RandomSampler, SubsetRandomSampler, SequentialSampler, BatchSampler
 from torchvision import transforms, utils, datasets
+from concurrent.futures import ProcessPoolExecutor
 
 """Mount Google Drive"""
 
@@ -62,46 +65,274 @@ device = T.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 """Class Declarations"""
 
-class RedundancyCrop(object):
-    """Squares off a 1280x720p PIL image by cropping the side of 
-        the image that contains no information.
-    Args:
-        None.
+from Network import RedundancyCrop, Network
+
+class CachedDataset(Dataset):
+  """Preprocessed copy of an ImageFolder, stored as a memory-mapped uint8
+      (N, H, W) array and a label index. The source transform is applied
+      once, samples are then read straight from the map.
+  Args:
+      source (ImageFolder): Dataset to cache, with its transform.
+      root (str): Cache directory.
+  """
+  def __init__(self, source, root='./cache'):
+    self.source = source
+    self.root = root
+    self.classes = source.classes
+    self.class_to_idx = source.class_to_idx
+    os.makedirs(self.root, exist_ok=True)
+
+    self.path = os.path.join(self.root, self.key())
+    if not os.path.exists(self.path + '.labels.npy'):
+      self.build(self.path)
+
+    self.open()
+    self.targets = np.load(self.path + '.labels.npy').tolist()
+
+  def open(self):
+    # Copy-on-write mapping, so tensors can share its memory without copying
+    self.images = np.load(self.path + '.npy', mmap_mode='c')
+
+  def __getstate__(self):
+    # Other processes map the same file rather than receiving a copy
+    state = self.__dict__.copy()
+    del state['images']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.open()
+
+  def key(self):
+    """Hash of the transform config and the name, size and mtime of every
+        source file, so any change to either builds a new cache."""
+    digest = hashlib.sha1(repr(self.source.transform).encode())
+    for path, label in self.source.samples:
+      digest.update(('%s|%d\n' % (self.fileKey(path), label)).encode())
+    return digest.hexdigest()
+
+  @staticmethod
+  def fileKey(path):
+    stat = os.stat(path)
+    return '%s|%d|%d' % (path, stat.st_size, stat.st_mtime_ns)
+
+  def build(self, path, batch_size=64):
+    print('Building cache \'%s\' (%d samples)' % (path, len(self.source)))
+    images = None
+    labels = np.array(self.source.targets, dtype=np.int64)
+    steps = self.source.transform.transforms if isinstance(self.source.transform, transforms.Compose) else None
+
+    if [type(step) for step in steps or []] == [transforms.Grayscale, RedundancyCrop, transforms.ToTensor]:
+      # Standard pipeline: crop whole greyscale batches at once, reusing
+      # the crop side of files seen by earlier builds
+      crop = steps[1]
+      sides_path = os.path.join(self.root, 'sides.pkl')
+      sides = pickle.load(open(sides_path, 'rb')) if os.path.exists(sides_path) else {}
+      for start in range(0, len(self.source), batch_size):
+        samples = self.source.samples[start:start + batch_size]
+        keys = [self.fileKey(sample) for sample, label in samples]
+        batch = T.from_numpy(np.stack([np.asarray(self.source.loader(sample).convert('L')) for sample, label in samples]))
+
+        known = T.tensor([key in sides for key in keys])
+        left = T.tensor([sides.get(key, False) for key in keys])
+        if not known.all():
+          left[~known] = crop.detect(batch[~known])
+          sides.update(zip(keys, left.tolist()))
+
+        batch = crop.crop(batch, left).numpy()
+        if images is None:
+          images = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.uint8, shape=(len(self.source),) + batch.shape[1:])
+        images[start:start + len(batch)] = batch
+      pickle.dump(sides, open(sides_path + '.tmp', 'wb'))
+      os.replace(sides_path + '.tmp', sides_path)
+    else:
+      for idx in range(len(self.source)):
+        sample, labels[idx] = self.source[idx]
+        image = (sample.squeeze(0) * 255).round().to(T.uint8).numpy()
+        if images is None:
+          images = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.uint8, shape=(len(self.source),) + image.shape)
+        images[idx] = image
+    images.flush()
+    del images
+
+    # Labels are written last and mark the cache as complete
+    os.replace(path + '.tmp.npy', path + '.npy')
+    np.save(path + '.labels.tmp.npy', labels)
+    os.replace(path + '.labels.tmp.npy', path + '.labels.npy')
+
+  def __len__(self):
+    return len(self.targets)
+
+  def __getitem__(self, idx):
+    return T.from_numpy(self.images[idx]).unsqueeze(0), self.targets[idx]
+
+  @staticmethod
+  def collate(batch):
+    """Stacks a batch of uint8 samples and scales it to [0, 1] floats, as
+        ToTensor would have, in one operation per batch."""
+    samples, labels = zip(*batch)
+    return T.stack(samples).float().div_(255), T.tensor(labels)
+
+class StoreDataset(Dataset):
+  """Classifier samples appended by the simulator's Recorder to a sample
+      store (--store), read straight from the shard files with no PNG
+      decode or crop.
+  Args:
+      root (str): Store directory.
+      classify (callable): Maps a scenario code to its label.
+      classes (list): Class folder style names ('0-...', '1-...').
+  """
+  def __init__(self, root, classify, classes=('0-negative', '1-positive')):
+    self.root = root
+    self.classify = classify
+    self.classes = list(classes)
+    self.shape = None # Sample shape, as recorded by the first shard
+    self.shards = {} # Path -> samples read and their mapping
+    self.segments = [] # (shard path, first sample) of each run of samples read
+    self.starts = np.zeros(0, dtype=np.int64) # First index of each segment
+    self.targets = []
+    self.codes = []
+    self.refresh()
+
+  def refresh(self):
+    """Picks up samples appended since the store was last read. Only the new
+        codes of shards that grew are read, and they are indexed after every
+        sample read before, so indices never move.
+    Returns:
+        int: Number of new samples.
+    Raises:
+        ValueError: If a shard's samples are not the shape of the others.
     """
-
-    def __init__(self):
-      pass
-
-    def __call__(self, img):
-        """
-        Args:
-            img (PIL Image): Image to be cropped.
-        Returns:
-            PIL Image: Cropped image.
-        """
-        np_img = np.array(img)
-        l_bbar = np_img[:,:560]
-        l_img = np_img[:,560:]
-        r_bbar = np_img[:,720:]
-        r_img = np_img[:,:720]
-
-        if np.any(l_bbar):
-          return Image.fromarray(r_img)
-        elif np.any(r_bbar):
-          return Image.fromarray(l_img)
-
-    def __repr__(self):
-        return self.__class__.__name__
+    added = 0
+    for path in sorted(glob.glob(os.path.join(self.root, 'samples-*.codes'))):
+      path = path[:-len('.codes')]
+      if path not in self.shards:
+        # Stores written before shapes were recorded are all 720x720
+        shape = (720, 720)
+        if os.path.exists(path + '.shape'):
+          with open(path + '.shape') as f:
+            shape = tuple(int(side) for side in f.read().split())
+        if self.shape is None:
+          self.shape = shape
+        elif shape != self.shape:
+          raise ValueError('Shard \'%s\' has %dx%d samples, the store has %dx%d' % ((path,) + shape + self.shape))
+      shard = self.shards.setdefault(path, dict(count=0))
+      count = os.path.getsize(path + '.codes') // 4
+      if count > shard['count']:
+        codes = np.fromfile(path + '.codes', dtype='S4', count=count - shard['count'], offset=4 * shard['count']).astype(str).tolist()
+        self.segments.append((path, shard['count']))
+        self.starts = np.append(self.starts, len(self.codes))
+        self.codes.extend(codes)
+        self.targets.extend(self.classify(code) for code in codes)
+        shard['count'] = count
+        shard.pop('images', None)
+        added += len(codes)
+    return added
+
+  def images(self, path):
+    shard = self.shards[path]
+    if 'images' not in shard:
+      shard['images'] = np.memmap(path + '.u8', dtype=np.uint8, mode='c', shape=(shard['count'],) + self.shape)
+    return shard['images']
+
+  def __getstate__(self):
+    # Other processes map the shard files themselves
+    state = self.__dict__.copy()
+    state['shards'] = {path: dict(count=shard['count']) for path, shard in self.shards.items()}
+    return state
+
+  def __len__(self):
+    return len(self.targets)
+
+  def __getitem__(self, idx):
+    segment = np.searchsorted(self.starts, idx, side='right') - 1
+    path, first = self.segments[segment]
+    image = self.images(path)[first + idx - self.starts[segment]]
+    return T.from_numpy(image).unsqueeze(0), self.targets[idx]
+
+  collate = staticmethod(CachedDataset.collate)
+
+class StreamDataset(IterableDataset):
+  """Tails a sample store while the simulator is still filling it. Each new
+      sample is yielded once as it arrives, followed by replayed samples
+      drawn from a bounded buffer of recent ones, so training can run
+      alongside generation. Loader workers each take every n-th sample.
+  Args:
+      store (StoreDataset): Store to tail, read from its first sample.
+      buffer (int): Replay buffer size.
+      replay (int): Replayed samples yielded per new sample.
+      poll (float): Seconds to wait for new samples.
+      timeout (float): Stop after this long without new samples, or never
+          if None.
+      seed (int): Replay sampling seed.
+  """
+  def __init__(self, store, buffer=1024, replay=1, poll=5, timeout=None, seed=0):
+    self.store = store
+    self.buffer = buffer
+    self.replay = replay
+    self.poll = poll
+    self.timeout = timeout
+    self.seed = seed
+
+  def __iter__(self):
+    info = torch.utils.data.get_worker_info()
+    worker, workers = (0, 1) if info is None else (info.id, info.num_workers)
+    rng = np.random.default_rng((self.seed, worker))
+    buffer = deque(maxlen=self.buffer)
+    seen = 0
+    idle = 0
+
+    while True:
+      if seen == len(self.store) and not self.store.refresh():
+        if self.timeout is not None and idle >= self.timeout:
+          return
+        time.sleep(self.poll)
+        idle += self.poll
+        continue
+      idle = 0
+
+      for idx in range(seen + (worker - seen) % workers, len(self.store), workers):
+        sample = self.store[idx]
+        buffer.append(sample)
+        yield sample
+        for _ in range(self.replay):
+          yield buffer[rng.integers(len(buffer))]
+      seen = len(self.store)
+
+class FoldSampler(Sampler):
+  """Yields a mutable list of dataset indices in order, so a loader (and its
+      persistent workers) can be built once and pointed at each fold in turn.
+  Args:
+      indices (list): Dataset indices to sample.
+  """
+  def __init__(self, indices=()):
+    self.indices = list(indices)
+
+  def __iter__(self):
+    return iter(self.indices)
+
+  def __len__(self):
+    return len(self.indices)
 
 class DataWrapper(object):
-  def __init__(self, data, folds=5, seed=2):
+  def __init__(self, data, folds=5, seed=2, workers=2, prefetch=2):
     self.data = data
     self.folds = folds
+    self.seed = seed
     self.current_fold = None
     self.samples = len(data)
-    self.folded_data = self.split()
+    self.folded_data = self.split(folds, seed)
     self.classes = [class_names[2:] for class_names in self.data.classes]
 
+    # Loader workers, and batches each keeps prepared ahead of training
+    self.workers = workers
+    self.prefetch = prefetch
+    self.batch_size = None
+
+    self.train_sampler = FoldSampler()
+    self.validate_sampler = FoldSampler()
+    self.test_sampler = FoldSampler()
+
     self.train_loader = None
     self.validate_loader = None
     self.test_loader = None
@@ -109,15 +340,14 @@ class DataWrapper(object):
   def split(self, folds=5, seed=0):
     self.folds = folds
 
-    split_length = int(np.floor(self.samples/self.folds))
-    partial_split_length = self.samples % self.folds
-
-    splitting = [split_length]*folds
-    splitting.append(partial_split_length)
+    # Shuffle each class and deal the classes across the folds in turn, so
+    # every sample is used and fold sizes (and per class counts) differ by at
+    # most one
+    rng = np.random.default_rng(seed)
+    targets = np.asarray(self.data.targets)
+    order = np.concatenate([rng.permutation(np.flatnonzero(targets == label)) for label in np.unique(targets)])
+    folded_data = [rng.permutation(order[idx::folds]) for idx in range(folds)]
 
-    folded_data = random_split(self.data, splitting, generator=torch.Generator().manual_seed(seed))
-    del folded_data[-1] # Drop incomplete fold
-    
     return folded_data
 
   def load(self, batch_size=4, seed=None):
@@ -131,20 +361,29 @@ class DataWrapper(object):
 
     idxs = np.roll(np.arange(self.folds), self.current_fold)
 
-    ls = tuple([self.folded_data[idx] for idx in idxs[:-2]])
+    # Loaders are kept across folds, only their samplers change
+    self.train_sampler.indices = np.concatenate([self.folded_data[idx] for idx in idxs[:-2]]).tolist()
+    self.validate_sampler.indices = self.folded_data[idxs[-2]].tolist()
+    self.test_sampler.indices = self.folded_data[idxs[-1]].tolist()
 
-    train = ConcatDataset(tuple([self.folded_data[idx] for idx in idxs[:-2]]))
-    validate =  self.folded_data[idxs[-2]]
-    test = self.folded_data[idxs[-1]]
+    if self.batch_size != batch_size:
+      self.batch_size = batch_size
+      self.train_loader = self.loader(self.train_sampler)
+      self.validate_loader = self.loader(self.validate_sampler)
+      self.test_loader = self.loader(self.test_sampler)
 
-    self.train_loader = DataLoader(train, batch_size=batch_size, num_workers=0, pin_memory=True, drop_last=True)
-    self.validate_loader = DataLoader(validate, batch_size = batch_size, num_workers=0, pin_memory=True, drop_last=True)
-    self.test_loader = DataLoader(test, batch_size = batch_size, num_workers=0, pin_memory=True, drop_last=True)
+  def loader(self, sampler):
+    options = dict(num_workers=self.workers, pin_memory=True, drop_last=True, collate_fn=getattr(self.data, 'collate', None))
+    if self.workers > 0:
+      options.update(prefetch_factor=self.prefetch, persistent_workers=True)
+    return DataLoader(self.data, batch_size=self.batch_size, sampler=sampler, **options)
 
   def show(self):
+    targets = np.asarray(self.data.targets)
 
     for idx, fold in enumerate(self.folded_data):
-      class_distributions = dict(Counter(elem[1] for elem in fold))
+      # Labels come from the dataset index, no sample is loaded
+      class_distributions = dict(Counter(targets[fold].tolist()))
       class_0 = class_distributions.get(0)
       class_1 = class_distributions.get(1)
 
@@ -152,47 +391,21 @@ class DataWrapper(object):
       print('  Class 0: %d' % (0 if class_0 is None else class_0))
       print('  Class 1: %d' % (0 if class_1 is None else class_1))
 
-class Network(nn.Module):
-    def __init__(self):
-        super(Network, self).__init__()
-        self.conv1 = nn.Conv2d(1, 4, kernel_size=7, stride=2)
-        self.pool1 = nn.MaxPool2d(2, 2)
-        self.conv2 = nn.Conv2d(4, 4, kernel_size=5, stride=2)
-        self.pool2 = nn.MaxPool2d(2, 2)
-        self.conv3 = nn.Conv2d(4, 4, kernel_size=3, stride=1)
-        self.conv4 = nn.Conv2d(4, 4, kernel_size=3, stride=1)
-        self.conv5 = nn.Conv2d(4, 4, kernel_size=3, stride=1)
-        self.pool5 = nn.MaxPool2d(2, 2)
-        self.fc1 = nn.Linear(4 * 18 * 18, 4096)
-        self.fc2 = nn.Linear(4096, 2048)
-
-    def forward(self, x):
-        x = F.relu(self.conv1(x))
-        x = nn.LayerNorm(x.size()[1:])(x)
-        x = self.pool1(x)
-        x = self.pool2(F.relu(self.conv2(x)))
-        x = F.relu(self.conv3(x))
-        x = F.relu(self.conv4(x))
-        x = self.pool5(F.relu(self.conv5(x)))
-        x = x.view(-1, 4 * 18 * 18)
-        x = F.relu(self.fc1(x))
-        x = F.relu(self.fc2(x))
-        return x
-
 class Classifier(object):
-  def __init__(self, data):
+  def __init__(self, data, **options):
     self.data = data
-    self.network = Network()
+    self.options = options # Network configuration
+    self.network = Network(**self.options)
     self.criterion = nn.CrossEntropyLoss()
     self.optimiser = optim.SGD(self.network.parameters(), lr=0.001, momentum=0.9)
-    self.accuracy = [None]*self.data.folds
+    self.accuracy = [None]*self.data.folds if self.data is not None else []
     
   def train(self, interval=100):
       running_loss = 0.0
       running_losses = []
       running_accuracy = []
 
-      for idx, batch in enumerate(data.train_loader):
+      for idx, batch in enumerate(self.data.train_loader):
           inputs, labels = batch
       
           self.optimiser.zero_grad()   # Zero parameter gradients
@@ -240,8 +453,45 @@ class Classifier(object):
   def nextFold(self):
     self.data.load()
 
+  def trainFold(self, fold, epochs=2, interval=100):
+    self.resetNetwork()
+    self.data.load(seed=fold)
+
+    running_losses = []
+    running_accuracies = []
+
+    for epoch in range(epochs):
+      print('\nFold: %d - Epoch %d '% (fold, epoch+1))
+
+      running_loss, running_accuracy = self.train(interval)
+
+      running_losses.append(running_loss)
+      running_accuracies.append(running_accuracy)
+
+    return running_losses, running_accuracies, self.validate(test=True)
+
+  def crossValidate(self, epochs=2, interval=100, processes=None):
+    """Trains every fold in its own process, each limited to an equal share
+        of the CPU threads. The processes map the same dataset cache.
+        Test accuracies are gathered into self.accuracy by fold.
+    Returns:
+        Losses and validation accuracies of each fold, per epoch.
+    """
+    processes = processes or self.data.folds
+    threads = max(1, os.cpu_count() // processes)
+
+    with ProcessPoolExecutor(processes, mp_context=mp.get_context('fork')) as pool:
+      jobs = [pool.submit(trainFold, self.data.data, self.data.folds, self.data.seed, fold, epochs, interval, threads, self.options) for fold in range(self.data.folds)]
+      results = [job.result() for job in jobs]
+
+    losses = [result[0] for result in results]
+    accuracies = [result[1] for result in results]
+    self.accuracy = [result[2] for result in results]
+
+    return losses, accuracies
+
   def resetNetwork(self):
-    self.network = Network()
+    self.network = Network(**self.options)
     self.criterion = nn.CrossEntropyLoss()
     self.optimiser = optim.SGD(self.network.parameters(), lr=0.001, momentum=0.9)
 
@@ -249,45 +499,76 @@ class Classifier(object):
     PATH = './' + fn + '.pth'
     self.network.load_state_dict(T.load(PATH))
 
+  def trainStream(self, stream, batch_size=4, interval=100, checkpoint=1000, fn='stream'):
+    """Trains on a StreamDataset until it stops, saving the model every
+        checkpoint minibatches (and at the end) with saveModel.
+    Returns:
+        list: Running loss every interval minibatches.
+    """
+    loader = DataLoader(stream, batch_size=batch_size, collate_fn=StoreDataset.collate)
+    running_loss = 0.0
+    running_losses = []
+
+    for idx, batch in enumerate(loader):
+      inputs, labels = batch
+
+      self.optimiser.zero_grad()
+      loss = self.criterion(self.network(inputs), labels)
+      loss.backward()
+      self.optimiser.step()
+
+      running_loss += loss.item()
+      if idx % interval == interval - 1:
+        print('Minibatch: %3d | Samples: %d | Loss -> %.3f' % (idx + 1, len(stream.store), running_loss / interval))
+        running_losses.append(running_loss / interval)
+        running_loss = 0.0
+      if idx % checkpoint == checkpoint - 1:
+        self.saveModel(fn)
+
+    self.saveModel(fn)
+    return running_losses
+
   def saveModel(self, fn='default'):
     PATH = './' + fn + '.pth'
     T.save(self.network.state_dict(), PATH)
 
+def trainFold(dataset, folds, seed, fold, epochs, interval, threads, options={}):
+  """Cross validation worker, trains and tests one fold with its own
+      network. Batches are loaded in the process itself.
+  """
+  T.set_num_threads(threads)
+  classifier = Classifier(DataWrapper(dataset, folds, seed, workers=0), **options)
+  return classifier.trainFold(fold, epochs, interval)
+
 """Data Import"""
 
 transform = transforms.Compose([transforms.Grayscale(), RedundancyCrop(), transforms.ToTensor()])
 raw_data = datasets.ImageFolder(root='./data', transform=transform)
 
-data = DataWrapper(raw_data)
+# Decode and crop every image once, epochs and folds read the cache
+data = DataWrapper(CachedDataset(raw_data))
+
+# Or read samples the simulator stored directly (--store), labelled by
+# scenario code, e.g. good overtaking distance against the rest (a named
+# function, so the dataset can be sent to cross validation processes):
+# def goodDistance(code):
+#   return int(code[3] == '2')
+# data = DataWrapper(StoreDataset('./samples', goodDistance))
+
+# Or train while the simulator is still generating, until it has been
+# idle for ten minutes:
+# stream = StreamDataset(StoreDataset('./samples', goodDistance), timeout=600)
+# Classifier(None).trainStream(stream)
 data.show()
 
 """Training & Testing"""
 
 classifier = Classifier(data)
 interval = 10
-losses = []
-accuracies = []
-validations = []
-
-
-for fold in range(classifier.data.folds):
-  classifier.resetNetwork()
-  classifier.nextFold()
-
-  running_losses = []
-  running_accuracies = []
-
-  for epoch in range(2):
-    print('\nFold: %d - Epoch %d '% (fold, epoch+1))
-
-    running_loss, running_accuracy = classifier.train(interval)
-
-    running_losses.append(running_loss)
-    running_accuracies.append(running_accuracy)
 
-  validations.append(classifier.validate(test=True))
-  losses.append(running_losses)
-  accuracies.append(running_accuracies)
+# Folds train concurrently, one process each
+losses, accuracies = classifier.crossValidate(epochs=2, interval=interval)
+validations = list(classifier.accuracy)
 
 
 print(classifier.accuracy)
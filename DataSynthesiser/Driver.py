@@ -0,0 +1,203 @@
+from os import environ
+environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '0'
+
+import multiprocessing as mp
+import numpy as np
+import signal
+import time
+import argparse
+
+from main import Simulator, buildScene
+from Rendering import profiles
+from Encoding import encoders
+from TrafficManagement import parseCode, ScenarioSampler
+
+# Runs a headless Simulator taking (index, code) work items until it is sent
+# None or the run is stopped. The outcome of every scenario is reported on
+# the results queue as (status, worker_id, index, code) once it is saved,
+# followed by ('exit', worker_id, None, None).
+def simulatorWorker(worker_id, work, results, stop, options):
+    # Interrupts are handled by the driver, which stops workers between scenarios
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    simulator = Simulator(profile=options['profile'], headless=True, workers=options['export_workers'],
+                          seed=options['seed'], shard=options['shard'], store=options['store'], encoder=options['encoder'])
+    buildScene(simulator, options['traffic'])
+    simulator.renderer.load(simulator.scene)
+
+    def report(future, index, code):
+        status = 'saved' if not future.cancelled() and future.exception() is None else 'failed'
+        results.put((status, worker_id, index, code))
+
+    while not stop.is_set():
+        item = work.get()
+        if item is None:
+            break
+
+        index, code = item
+        simulator.index = index
+        try:
+            code, future = simulator.runScenario(code)
+        except Exception as e:
+            print('ERROR: Simulator %d: Scenario %d failed: %s' % (worker_id, index, e))
+            simulator.recorder.clear()
+            results.put(('failed', worker_id, index, code))
+            continue
+        future.add_done_callback(lambda future, index=index, code=code: report(future, index, code))
+
+    simulator.close()
+    results.put(('exit', worker_id, None, None))
+
+
+# Generates a target number of scenarios across worker processes. Work is
+# handed out a few items per worker at a time so scenarios that fail are
+# simply issued again under a new index, until target have been saved. With
+# targets ({pattern: count}, see ScenarioSampler) types are steered towards
+# the target counts instead, and the run ends once they have all been met.
+class Driver(object):
+    def __init__(self, target=None, processes=2, distribution=None, profile=None, export_workers=1, traffic=0, seed=None, shard=0, start=0, targets=None, store=None, encoder='ffv1'):
+        self.processes = processes
+        self.index = start # Next scenario index to issue
+
+        # Scenario types are drawn from distribution ({code: weight}),
+        # otherwise left to the simulator
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+            print('INFO: Run seed: %d' % seed)
+        self.rng = np.random.default_rng(np.random.SeedSequence((seed, shard)))
+        self.sampler = None
+        if targets is not None:
+            self.sampler = ScenarioSampler(targets, self.rng)
+            target = self.sampler.total()
+        elif target is None:
+            raise ValueError('A target count or target counts per type are required')
+        self.target = target
+        
+        self.codes = None
+        if distribution is not None:
+            self.codes = list(distribution)
+            for code in self.codes:
+                parseCode(code)
+            weights = np.array([distribution[code] for code in self.codes], dtype=np.float64)
+            self.weights = weights / weights.sum()
+
+        if profile is not None:
+            profile.check()
+        self.options = dict(profile=profile, export_workers=export_workers, traffic=traffic, seed=seed, shard=shard, store=store, encoder=encoder)
+        self.counts = {} # Scenarios saved per code
+        self.saved = 0
+        self.failed = 0
+
+    # Type of the next scenario, or None for the simulator to draw it
+    def nextCode(self):
+        if self.sampler is not None:
+            return self.sampler.next()
+        if self.codes is None:
+            return None
+        return self.codes[self.rng.choice(len(self.codes), p=self.weights)]
+        
+    # Whether more scenarios than those pending could be needed
+    def needs(self, pending):
+        if self.sampler is not None:
+            return self.sampler.deficit(self.sampler.issued).max() > 0
+        return self.saved + pending < self.target
+        
+    def finished(self):
+        if self.sampler is not None:
+            return self.sampler.done()
+        return self.saved >= self.target
+
+    def run(self):
+        work = mp.Queue()
+        results = mp.Queue()
+        stop = mp.Event()
+        workers = [mp.Process(target=simulatorWorker, args=(worker_id, work, results, stop, self.options)) for worker_id in range(self.processes)]
+        for worker in workers:
+            worker.start()
+
+        start = time.perf_counter()
+        pending = 0 # Issued, not yet reported
+        running = len(workers)
+        stopping = False
+        while running:
+            # Keep every worker busy without issuing more than could be needed
+            while not stopping and pending < 2 * self.processes and self.needs(pending):
+                work.put((self.index, self.nextCode()))
+                self.index += 1
+                pending += 1
+
+            if not stopping and self.finished():
+                stopping = True
+                for _ in workers:
+                    work.put(None)
+
+            try:
+                status, worker_id, index, code = results.get()
+            except KeyboardInterrupt:
+                print('INFO: Preparing to quit... ')
+                stop.set()
+                if not stopping:
+                    stopping = True
+                    for _ in workers:
+                        work.put(None)
+                continue
+
+            if status == 'exit':
+                running -= 1
+                continue
+
+            pending -= 1
+            if self.sampler is not None:
+                self.sampler.resolve(code, status == 'saved')
+            if status == 'saved':
+                self.saved += 1
+                self.counts[code] = self.counts.get(code, 0) + 1
+            else:
+                self.failed += 1
+                print('WARNING: Scenario %d (%s) failed, reissuing.' % (index, code))
+
+            elapsed = time.perf_counter() - start
+            rate = self.saved / elapsed
+            print('INFO: %d/%d scenarios saved (%.2f scenarios/s, %d failed, ETA %.0fs)' % (self.saved, self.target, rate, self.failed, (self.target - self.saved) / rate if rate else float('inf')))
+
+        for worker in workers:
+            worker.join()
+        print('INFO: Saved scenarios per type: %s' % dict(sorted(self.counts.items())))
+        if self.sampler is not None:
+            print('INFO: Saved scenarios per target: %s' % self.sampler.counts())
+        return self.counts
+
+
+# Parse 'code:weight,code:weight' into {code: weight}
+def parseDistribution(text):
+    distribution = {}
+    for item in text.split(','):
+        code, weight = item.split(':')
+        distribution[code.strip()] = float(weight)
+    return distribution
+    
+# Parse 'pattern:count,pattern:count' into {pattern: count}
+def parseTargets(text):
+    return {pattern: int(count) for pattern, count in parseDistribution(text).items()}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target', type=int, nargs='?', default=None, help='number of scenarios to generate')
+    parser.add_argument('--processes', type=int, default=mp.cpu_count(), help='simulator worker processes')
+    parser.add_argument('--distribution', type=parseDistribution, default=None, help='scenario type weights as code:weight,... (default as drawn by the simulator)')
+    parser.add_argument('--targets', type=parseTargets, default=None, help='scenarios to generate per type as pattern:count,... where ? in a pattern matches any digit')
+    parser.add_argument('--export-workers', type=int, default=1, help='recorder export workers per process')
+    parser.add_argument('--traffic', type=int, default=0, help='number of background traffic vehicles')
+    parser.add_argument('--seed', type=int, default=None, help='run seed shared by every shard of a dataset (random if not given)')
+    parser.add_argument('--shard', type=int, default=0, help='shard of the dataset generated by this driver')
+    parser.add_argument('--start', type=int, default=0, help='index of the first scenario in the shard')
+    parser.add_argument('--profile', choices=sorted(profiles), default='full', help='render profile (resolution and channels)')
+    parser.add_argument('--encoder', choices=sorted(encoders), default='ffv1', help='frame encoder: none (flow only), ffv1 video, npy raw stack or npz compressed chunks')
+    parser.add_argument('--store', metavar='DIR', default=None, help='append cropped flow masks to a classifier sample store instead of writing PNGs')
+    args = parser.parse_args()
+
+    driver = Driver(args.target, args.processes, args.distribution, profiles[args.profile], export_workers=args.export_workers, traffic=args.traffic, seed=args.seed, shard=args.shard, start=args.start, targets=args.targets, store=args.store, encoder=args.encoder)
+    driver.run()
+    print('INFO: Simulation terminated.')
@@ -0,0 +1,150 @@
+from abc import ABC, abstractmethod
+
+import cv2
+import time
+import zipfile
+import numpy as np
+
+from pathlib import Path
+
+from config import _FPS
+
+# Writes the frames of one recording. Frames are (H,W,3) RGB or (H,W) blue
+# arrays of size (W,H). The time spent encoding and the bytes written are
+# tracked so backends can be compared per deployment.
+class Encoder(ABC):
+    extension = ''
+
+    def __init__(self, path, size, channels=3):
+        self.path = path + self.extension
+        self.size = size
+        self.channels = channels
+        self.frames = 0
+        self.time = 0 # Seconds spent encoding
+
+    def encode(self, frame):
+        start = time.perf_counter()
+        self.write(frame)
+        self.time += time.perf_counter() - start
+        self.frames += 1
+
+    def finish(self):
+        start = time.perf_counter()
+        self.close()
+        self.time += time.perf_counter() - start
+
+    # Bytes written, once finished
+    def bytes(self):
+        return Path(self.path).stat().st_size if self.extension else 0
+
+    def stats(self):
+        frames = max(self.frames, 1)
+        return '%s %.1f KB/frame, %.2f ms/frame (%.0f frames/s)' % (self.__class__.__name__, self.bytes() / frames / 1024, 1000 * self.time / frames, self.frames / self.time if self.time else float('inf'))
+
+    # Remove partial output
+    def discard(self):
+        self.close()
+        if self.extension:
+            Path(self.path).unlink(missing_ok=True)
+
+    # Abstract method
+    def write(self, frame):
+        pass
+
+    # Abstract method
+    def close(self):
+        pass
+
+
+# Flow only, frames are not kept
+class NullEncoder(Encoder):
+    def write(self, frame):
+        pass
+
+    def close(self):
+        pass
+
+
+# Lossless FFV1 video, compact but the slowest
+class VideoEncoder(Encoder):
+    extension = '.avi'
+
+    def __init__(self, path, size, channels=3):
+        super().__init__(path, size, channels)
+        self.out = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc('F','F','V','1'), _FPS, size, isColor=channels == 3)
+
+    def write(self, frame):
+        # Convert from RGB
+        self.out.write(np.flip(frame, 2) if frame.ndim == 3 else frame)
+
+    def close(self):
+        self.out.release()
+
+
+# Raw .npy stack of every frame, the fastest to write and to read back.
+# The header is written up front with room for the final frame count and
+# rewritten in place on close.
+class NpyEncoder(Encoder):
+    extension = '.npy'
+    header_size = 128 # Multiple of 64 as numpy aligns it
+
+    def __init__(self, path, size, channels=3):
+        super().__init__(path, size, channels)
+        self.out = open(self.path, 'wb')
+        self.writeHeader()
+
+    def writeHeader(self):
+        shape = (self.frames, self.size[1], self.size[0]) + ((3,) if self.channels == 3 else ())
+        header = "{'descr': '|u1', 'fortran_order': False, 'shape': %s, }" % repr(shape)
+        header = header.ljust(self.header_size - 10 - 1) + '\n'
+        self.out.seek(0)
+        self.out.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+
+    def write(self, frame):
+        self.out.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self):
+        if not self.out.closed:
+            self.writeHeader()
+            self.out.close()
+
+
+# Frames deflated in chunks to one .frames.npz (chunk_00000, ...), a
+# middle ground between disk and CPU
+class ChunkEncoder(Encoder):
+    extension = '.frames.npz' # Trajectories are saved to .npz
+
+    def __init__(self, path, size, channels=3, chunk=32):
+        super().__init__(path, size, channels)
+        self.chunk = chunk
+        self.buffer = []
+        self.chunks = 0
+        self.out = zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    # Frames are copied, the caller may reuse their memory (shared memory
+    # slots are handed back to the simulator once written)
+    def write(self, frame):
+        self.buffer.append(np.array(frame, copy=True))
+        if len(self.buffer) == self.chunk:
+            self.flush()
+
+    def flush(self):
+        with self.out.open('chunk_%05d.npy' % self.chunks, 'w', force_zip64=True) as entry:
+            np.lib.format.write_array(entry, np.stack(self.buffer))
+        self.buffer = []
+        self.chunks += 1
+
+    def close(self):
+        if self.out.fp is not None:
+            if len(self.buffer):
+                self.flush()
+            self.out.close()
+
+
+# Encoders by name
+encoders = dict(
+                    none = NullEncoder,
+                    ffv1 = VideoEncoder,
+                    npy = NpyEncoder,
+                    npz = ChunkEncoder
+                )
@@ -1,24 +1,66 @@
 from abc import ABC, abstractmethod
 
-from OpenGL.GL import *
-from OpenGL.GLU import *
+import numpy as np
 
 from config import _SCALE
 from config import _SPEED
 
+# Cube vertex offsets as multiples of its shape (indexed by Cube.edges and Cube.surfaces)
+_CORNERS = np.array((
+                        ( 1,-1,-1),( 1, 1,-1),(-1, 1,-1),(-1,-1,-1),
+                        ( 1,-1, 1),( 1, 1, 1),(-1,-1, 1),(-1, 1, 1)
+                    ), dtype=np.float32) / 2
+
+# Contiguous store of every cube's origin and shape. Geometry objects are views
+# onto rows of a scene, so translating and generating vertices for the whole
+# scene are single vectorised operations.
+class Scene(object):
+    def __init__(self):
+        self.origins = np.zeros((0,3))
+        self.shapes = np.zeros((0,3))
+        self.colours = np.zeros((0,3), dtype=np.float32)
+        self.fill = np.zeros(0, dtype=bool)
+        self.vertices = np.zeros((0,8,3), dtype=np.float32)
+        
+    def __len__(self):
+        return len(self.origins)
+        
+    # Append rows to the store, returns the slice they occupy
+    def allocate(self, origins, shapes, colours, fill):
+        start = len(self)
+        self.origins = np.concatenate((self.origins, origins))
+        self.shapes = np.concatenate((self.shapes, shapes))
+        self.colours = np.concatenate((self.colours, colours)).astype(np.float32)
+        self.fill = np.concatenate((self.fill, fill)).astype(bool)
+        self.vertices = np.zeros((len(self),8,3), dtype=np.float32)
+        return slice(start, len(self))
+        
+    # Move geometry from the store it currently views into this one
+    def add(self, geometry):
+        old, rows = geometry.scene, geometry.rows
+        geometry.bind(self, self.allocate(old.origins[rows], old.shapes[rows], old.colours[rows], old.fill[rows]))
+        
+    # Vertices of every cube in the store (N,8,3), updated in place
+    def updateModel(self):
+        np.multiply(self.shapes[:,None,:], _CORNERS, out=self.vertices)
+        np.add(self.vertices, self.origins[:,None,:], out=self.vertices)
+        return self.vertices
+        
+
 class Geometry(ABC):
     def __init__(self, origin=(0,0,0), shape=(1,1,0), colour=(1,1,1), fill=False):
-        self.origin = tuple([coord * _SCALE for coord in origin])
-        self.shape = tuple([dim * _SCALE for dim in shape])
         self.colour = colour
         self.fill = fill
+        self.scene = None
+        self.rows = None
+        
+    # View rows of a scene
+    def bind(self, scene, rows):
+        self.scene = scene
+        self.rows = rows
         
     def setShape(self, shape):
-        self.shape = tuple([dim * _SCALE for dim in shape])
-    
-    # Abstract method
-    def render(self):
-        pass
+        self.scene.shapes[self.rows] = np.multiply(shape, _SCALE)
     
     # Abstract method
     def translate(self):
@@ -26,65 +68,40 @@ class Geometry(ABC):
     
     
 class Cube(Geometry):
+    edges = (
+                (0,1),(0,3),(0,4),
+                (2,1),(2,3),(2,7),
+                (6,3),(6,4),(6,7),
+                (5,1),(5,4),(5,7)
+            )
+    surfaces = (
+                    (0,1,2,3),
+                    (3,2,7,6),
+                    (6,7,5,4),
+                    (4,5,1,0),
+                    (1,5,7,2),
+                    (4,0,3,6)
+                )
+    
     def __init__(self, origin=(0,0,0), shape=(1,1,0), colour=(1,0,0), fill=False):
         super().__init__(origin, shape, colour, fill)
-        self.edges = (
-                        (0,1),(0,3),(0,4),
-                        (2,1),(2,3),(2,7),
-                        (6,3),(6,4),(6,7),
-                        (5,1),(5,4),(5,7)
-                    )
-        self.surfaces = (
-                            (0,1,2,3),
-                            (3,2,7,6),
-                            (6,7,5,4),
-                            (4,5,1,0),
-                            (1,5,7,2),
-                            (4,0,3,6)
-                        )
         
-    def render(self):
-        self.updateModel()
-        glBegin(GL_LINES)
-        glColor3fv(self.colour)
-        for edge in self.edges:
-            for vertex in edge:
-                glVertex3fv(self.vertices[vertex])
-        glEnd()
+        # Standalone until added to a shared scene
+        scene = Scene()
+        self.bind(scene, scene.allocate(np.multiply([origin], _SCALE), np.multiply([shape], _SCALE), [colour], [fill]))
+        
+    @property
+    def origin(self):
+        return self.scene.origins[self.rows.start]
+        
+    @property
+    def shape(self):
+        return self.scene.shapes[self.rows.start]
         
-        if self.fill:
-            glBegin(GL_QUADS)
-            for surface in self.surfaces:
-                x = 0
-                for vertex in surface:
-                    x+=1
-                    glVertex3fv(self.vertices[vertex])
-            glEnd()
-    
     # Raw translation is by real distance, not speed
     def translate(self, transform, raw=False):
-        if not raw:
-            transform = tuple([coord * _SPEED for coord in transform])
-        else:
-            transform = tuple([coord * _SCALE for coord in transform])
-            
-        self.origin = (
-                        self.origin[0] + transform[0],
-                        self.origin[1] + transform[1],
-                        self.origin[2] + transform[2]
-                    )
-        
-    def updateModel(self):
-        self.vertices = (
-                        (self.origin[0] + self.shape[0]/2, self.origin[1] - self.shape[1]/2, self.origin[2] - self.shape[2]/2),
-                        (self.origin[0] + self.shape[0]/2, self.origin[1] + self.shape[1]/2, self.origin[2] - self.shape[2]/2),
-                        (self.origin[0] - self.shape[0]/2, self.origin[1] + self.shape[1]/2, self.origin[2] - self.shape[2]/2),
-                        (self.origin[0] - self.shape[0]/2, self.origin[1] - self.shape[1]/2, self.origin[2] - self.shape[2]/2),
-                        (self.origin[0] + self.shape[0]/2, self.origin[1] - self.shape[1]/2, self.origin[2] + self.shape[2]/2),
-                        (self.origin[0] + self.shape[0]/2, self.origin[1] + self.shape[1]/2, self.origin[2] + self.shape[2]/2),
-                        (self.origin[0] - self.shape[0]/2, self.origin[1] - self.shape[1]/2, self.origin[2] + self.shape[2]/2),
-                        (self.origin[0] - self.shape[0]/2, self.origin[1] + self.shape[1]/2, self.origin[2] + self.shape[2]/2)
-                        )
+        origin = self.origin
+        origin += np.multiply(transform, _SCALE if raw else _SPEED)
 
 class DashedLine(Geometry):
     def __init__(self, origin=(0,0,0), shape=(0.15,0,2), colour=(0,1,0), fill=False):
@@ -93,17 +110,21 @@ class DashedLine(Geometry):
         for z_origin in range(-1,-240,-9):
             self.dashes.append(Cube(origin=(origin[0], origin[1], z_origin), shape=shape, colour=colour))
         
-    def render(self):
+        # Dashes are kept contiguous so the line moves as one slice
+        scene = Scene()
         for dash in self.dashes:
-            dash.render()
+            scene.add(dash)
+        self.bind(scene, slice(0, len(scene)))
+        
+    def bind(self, scene, rows):
+        super().bind(scene, rows)
+        for idx, dash in enumerate(self.dashes):
+            dash.bind(scene, slice(rows.start + idx, rows.start + idx + 1))
         
     def translate(self, transform, raw=False):
-        for dash in self.dashes:
-            dash.translate(transform, raw)
+        origins = self.scene.origins[self.rows]
+        origins += np.multiply(transform, _SCALE if raw else _SPEED)
         
-        if self.dashes[0].origin[2] > 1*_SCALE:
-            dash = self.dashes.pop(0)
-            # Had to convert from distance to _SPEED
-            #dash.translate((0,0,-15099.32))
-            dash.translate((0,0,-240), True)
-            self.dashes.append(dash)
\ No newline at end of file
+        # Dashes that have passed the camera wrap round to the far end
+        z = origins[:,2]
+        z[z > 1*_SCALE] -= 240*_SCALE
@@ -0,0 +1,334 @@
+from abc import ABC, abstractmethod
+
+import ctypes
+import cv2
+import numpy as np
+
+import pygame
+from pygame.locals import *
+
+from OpenGL.GL import *
+from OpenGL.GLU import *
+from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as glReadPixelsRaw
+
+from config import _SCALE, _FRAME
+
+from Geometry import *
+
+# Camera height above the road surface
+_CAMERA_HEIGHT = 1.2 * _SCALE
+
+# What a renderer produces: frames are projected as if at resolution, but
+# only the window (x, y, width, height from the top left) is drawn and read
+# back, with all three colour channels or only blue (channels=1), the
+# channel the optical flow tracker follows.
+class RenderProfile(object):
+    def __init__(self, resolution=(1280,720), window=None, channels=3):
+        self.resolution = tuple(resolution)
+        self.window = tuple(window) if window is not None else (0, 0) + self.resolution
+        self.channels = channels
+        
+    # (width, height) of the frames produced
+    def size(self):
+        return self.window[2:]
+        
+    # Array shape of the frames produced
+    def shape(self):
+        width, height = self.size()
+        return (height, width) if self.channels == 1 else (height, width, 3)
+        
+    # Every recording feeds the classifier, as flow PNGs or store samples,
+    # which only takes _FRAME frames. Raises ValueError for any other size.
+    def check(self):
+        if tuple(self.size()) != _FRAME:
+            raise ValueError('The classifier needs %dx%d frames, the profile gives %dx%d' % (_FRAME + tuple(self.size())))
+        
+# Profiles by name, pixels per frame relative to full are 1 and 1/3
+profiles = dict(
+                    full = RenderProfile(),
+                    blue = RenderProfile(channels=1)
+                )
+
+
+# Retained draw lists for a Scene: line and quad vertex arrays are allocated
+# once and refilled in place from the scene's vertices each frame, so that a
+# frame is drawn in a handful of calls. Must be rebuilt if the scene grows.
+class Batch(object):
+    def __init__(self, scene):
+        self.scene = scene
+        self.edges = np.array(Cube.edges).ravel()
+        self.surfaces = np.array(Cube.surfaces).ravel()
+        self.filled = np.flatnonzero(scene.fill)
+
+        self.line_colours = np.repeat(scene.colours, len(self.edges), axis=0)
+        self.fill_colours = np.repeat(scene.colours[self.filled,None], len(self.surfaces), axis=1)
+        self.line_buffer = np.zeros((len(scene), len(self.edges), 3), dtype=np.float32)
+        self.quad_buffer = np.zeros((len(self.filled), len(self.surfaces), 3), dtype=np.float32)
+        self.quad_colour_buffer = self.fill_colours.copy()
+        self.lines = self.line_buffer.reshape(-1,3)
+        self.quads = self.quad_buffer.reshape(-1,3)
+        self.quad_colours = self.quad_colour_buffer.reshape(-1,3)
+
+        self.update()
+
+    def update(self):
+        vertices = self.scene.updateModel()
+
+        # Lines are drawn before quads, filled geometry is expected last.
+        # There is no depth test, so quads are painted far to near (-ve Z)
+        np.take(vertices, self.edges, axis=1, out=self.line_buffer)
+        order = np.argsort(vertices[self.filled,:,2].mean(axis=1), kind='stable')
+        np.take(vertices[self.filled[order]], self.surfaces, axis=1, out=self.quad_buffer)
+        np.take(self.fill_colours, order, axis=0, out=self.quad_colour_buffer)
+
+
+class Renderer(ABC):
+    def __init__(self, profile, fovy):
+        self.profile = profile
+        self.resolution = profile.resolution
+        self.window = profile.window
+        self.channels = profile.channels
+        self.fovy = fovy
+        self.near = 0.1 * _SCALE
+        self.far = 200 * _SCALE
+        self.camera = 0
+        self.batch = None
+
+    # Camera translation along X (lane offset, inverted as is OpenGL translation)
+    def setCamera(self, x):
+        self.camera = x
+
+    # Pack the scene for drawing, must be called again if the scene grows
+    def load(self, scene):
+        self.batch = Batch(scene)
+
+    # Abstract method
+    def clear(self):
+        pass
+
+    # Abstract method
+    def draw(self):
+        pass
+
+    # Abstract method
+    def flip(self):
+        pass
+
+    # Abstract method, returns the last drawn frame as a (H,W,3) RGB array, or
+    # (H,W) blue for single channel profiles, or None if it has not finished
+    # transferring yet
+    def read(self):
+        pass
+
+    # Frames still in flight, in order
+    def flush(self):
+        return []
+
+    # Abstract method
+    def close(self):
+        pass
+
+
+class WindowRenderer(Renderer):
+    def __init__(self, profile, fovy, readback='async', buffers=2):
+        super().__init__(profile, fovy)
+        self.readback = readback
+        self.size = profile.size()
+        self.format = GL_BLUE if self.channels == 1 else GL_RGB
+
+        # Start pygame window (only the profile window) and configure perspective
+        pygame.init()
+        self.display = pygame.display.set_mode(self.size, DOUBLEBUF|OPENGL|NOFRAME)
+        glMatrixMode(GL_PROJECTION)
+        gluPerspective(fovy, (self.resolution[0]/self.resolution[1]), self.near, self.far)
+        glMatrixMode(GL_MODELVIEW)
+        
+        # The full frame viewport, offset so that the window is what is drawn
+        x, y, width, height = self.window
+        glViewport(-x, -(self.resolution[1] - y - height), self.resolution[0], self.resolution[1])
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+
+        # Ring of pixel buffers, glReadPixels into one returns immediately and
+        # the frame is mapped once the following frames have been drawn
+        self.frame_size = self.size[0] * self.size[1] * self.channels
+        self.pbos = []
+        self.head = 0 # Frames requested
+        self.tail = 0 # Frames returned
+        if self.readback == 'async':
+            glPixelStorei(GL_PACK_ALIGNMENT, 1)
+            self.pbos = glGenBuffers(buffers) if buffers > 1 else [glGenBuffers(1)]
+            for pbo in self.pbos:
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+                glBufferData(GL_PIXEL_PACK_BUFFER, self.frame_size, None, GL_STREAM_READ)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def clear(self):
+        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+        glLoadIdentity()
+        glTranslatef(0, -_CAMERA_HEIGHT, 0)
+        glTranslatef(self.camera, 0, 0)
+
+    def draw(self):
+        self.batch.update()
+
+        glVertexPointer(3, GL_FLOAT, 0, self.batch.lines)
+        glColorPointer(3, GL_FLOAT, 0, self.batch.line_colours)
+        glDrawArrays(GL_LINES, 0, len(self.batch.lines))
+
+        if len(self.batch.quads):
+            glVertexPointer(3, GL_FLOAT, 0, self.batch.quads)
+            glColorPointer(3, GL_FLOAT, 0, self.batch.quad_colours)
+            glDrawArrays(GL_QUADS, 0, len(self.batch.quads))
+
+    def flip(self):
+        pygame.display.flip()
+
+    def read(self):
+        if self.readback != 'async':
+            frame = pygame.image.tostring(self.display, "RGB")
+            frame = np.frombuffer(frame, dtype=np.uint8).reshape(self.size[1], self.size[0], 3)
+            return frame[:,:,2] if self.channels == 1 else frame
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[self.head % len(self.pbos)])
+        glReadPixelsRaw(0, 0, self.size[0], self.size[1], self.format, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.head += 1
+
+        if self.head - self.tail < len(self.pbos):
+            return None
+        return self.map()
+
+    def flush(self):
+        frames = []
+        while self.tail < self.head:
+            frames.append(self.map())
+        return frames
+
+    # Copy the oldest pending pixel buffer out, flipped to top-down rows
+    def map(self):
+        frame = np.empty(self.profile.shape(), dtype=np.uint8)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[self.tail % len(self.pbos)])
+        ptr = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        ctypes.memmove(frame.ctypes.data, ptr, self.frame_size)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.tail += 1
+        return frame[::-1]
+
+    def close(self):
+        if len(self.pbos):
+            glDeleteBuffers(len(self.pbos), self.pbos)
+        pygame.quit()
+
+
+# Pure software rasteriser for the line and quad primitives drawn by Cube,
+# used when no display (or GPU) is available. Only the profile window is
+# allocated and drawn, cv2 clips anything outside it.
+class SoftwareRenderer(Renderer):
+    def __init__(self, profile, fovy):
+        super().__init__(profile, fovy)
+        self.framebuffer = None
+        self.shift = 4 # Sub-pixel bits for cv2 fixed point coordinates
+
+        # Same focal lengths as gluPerspective
+        self.fy = 1 / np.tan(np.radians(fovy) / 2)
+        self.fx = self.fy / (self.resolution[0] / self.resolution[1])
+
+    def load(self, scene):
+        super().load(scene)
+
+        # Lines are grouped by colour so each colour is a single draw call,
+        # single channel frames are drawn in the blue component
+        colours = np.rint(self.batch.line_colours[::len(self.batch.edges)] * 255).astype(np.uint8)
+        if self.channels == 1:
+            colours = colours[:,2:]
+        self.palette, colour_ids = np.unique(colours, axis=0, return_inverse=True)
+        self.colour_ids = np.repeat(colour_ids.ravel(), len(self.batch.edges) // 2)
+
+    # Each frame gets a fresh framebuffer which is handed off by read, no copy
+    def clear(self):
+        self.framebuffer = np.zeros(self.profile.shape(), dtype=np.uint8)
+
+    def draw(self):
+        self.batch.update()
+
+        # All line segments clipped and projected at once
+        segments, keep = self.clipSegments(self.toEye(self.batch.lines).reshape(-1,2,3))
+        segments = self.project(segments.reshape(-1,3)).reshape(-1,2,2)
+        colour_ids = self.colour_ids[keep]
+        for colour_id, colour in enumerate(self.palette.tolist()):
+            lines = segments[colour_ids == colour_id]
+            if len(lines):
+                cv2.polylines(self.framebuffer, lines, False, colour, 1, cv2.LINE_8, self.shift)
+
+        # Filled geometry is rare (vehicles), clip each quad separately
+        quads = self.toEye(self.batch.quads).reshape(-1,4,3)
+        colours = np.rint(self.batch.quad_colours[::4] * 255).astype(np.uint8)
+        colours = (colours[:,2:] if self.channels == 1 else colours).tolist()
+        for quad, colour in zip(quads, colours):
+            polygon = self.clipPolygon(quad)
+            if len(polygon) > 2:
+                cv2.fillConvexPoly(self.framebuffer, self.project(polygon), colour, cv2.LINE_8, self.shift)
+
+    def flip(self):
+        pass
+
+    def read(self):
+        return self.framebuffer
+
+    def close(self):
+        pass
+
+    # World space -> eye space (camera looks down -ve Z)
+    def toEye(self, vertices):
+        return vertices.astype(np.float64) + (self.camera, -_CAMERA_HEIGHT, 0)
+
+    # Eye space -> fixed point window pixel coordinates, matching the GL viewport transform
+    def project(self, vertices):
+        depth = -vertices[:,2]
+        x = (self.fx * vertices[:,0] / depth + 1) / 2 * self.resolution[0] - 0.5 - self.window[0]
+        y = (1 - self.fy * vertices[:,1] / depth) / 2 * self.resolution[1] - 0.5 - self.window[1]
+        return np.rint(np.stack((x, y), axis=1) * (1 << self.shift)).astype(np.int32)
+
+    # Clip planes as (z, sign), a point is inside when sign * (z - point z) >= 0
+    def planes(self):
+        return ((-self.near, 1), (-self.far, -1))
+
+    # Clip (N,2,3) segments against the near and far planes, returns the
+    # clipped segments and a mask of which input segments survived
+    def clipSegments(self, segments):
+        keep = np.ones(len(segments), dtype=bool)
+        for plane, sign in self.planes():
+            a, b = segments[:,0], segments[:,1]
+            da = sign * (plane - a[:,2])
+            db = sign * (plane - b[:,2])
+            inside = (da >= 0) | (db >= 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                hit = a + (da / (da - db))[:,None] * (b - a)
+            a = np.where((da < 0)[:,None], hit, a)
+            b = np.where((db < 0)[:,None], hit, b)
+            segments = np.stack((a, b), axis=1)[inside]
+            keep[keep] = inside
+        return segments, keep
+
+    # Sutherland-Hodgman clip of a convex polygon against the near and far planes
+    def clipPolygon(self, vertices):
+        for plane, sign in self.planes():
+            inside = sign * (plane - vertices[:,2]) >= 0
+            if inside.all():
+                continue
+            if not inside.any():
+                return vertices[:0]
+
+            clipped = []
+            for i in range(len(vertices)):
+                j = (i + 1) % len(vertices)
+                a, b = vertices[i], vertices[j]
+                if inside[i]:
+                    clipped.append(a)
+                if inside[i] != inside[j]:
+                    t = (plane - a[2]) / (b[2] - a[2])
+                    clipped.append(a + t * (b - a))
+            vertices = np.array(clipped)
+        return vertices
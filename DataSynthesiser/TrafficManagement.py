@@ -6,44 +6,211 @@ from config import _LANEWIDTH
 
 from Geometry import *
 
-class TrafficManager(object):
+from bisect import bisect_left
+
+# Scenario type code -> (camera lane, start lane, target lane, distance
+# bracket), lanes relative to centre. The overtaking vehicle never starts in
+# the camera's lane.
+def parseCode(code):
+    if len(code) != 4 or not code.isdigit():
+        raise ValueError('Invalid scenario type \'%s\'' % code)
+    cam_pos, car_pos, car_dest, dist_bracket = [int(c) for c in code]
+    if cam_pos == car_pos or max(cam_pos, car_pos, car_dest) > 2 or dist_bracket > 2:
+        raise ValueError('Invalid scenario type \'%s\'' % code)
+    return cam_pos-1, car_pos-1, car_dest-1, dist_bracket
+
+# Ranges of the random draws of a scenario, in the order they are drawn:
+# vehicle model, camera lane, start lane offset from the camera lane, target
+# lane, distance bracket and distance offset. Live and batched scenarios draw
+# the same sequence, so a seeded scenario is the same either way.
+_DRAWS = ((-50,51), (-1,2), (1,3), (-1,2), (0,3), (-5,6))
+
+def drawScenario(rng):
+    return [rng.integers(low, high) for low, high in _DRAWS]
+
+# Every valid scenario type code
+_CODES = [cam + car + dest + dist for cam in '012' for car in '012' for dest in '012' for dist in '012' if cam != car]
+
+# Steers scenario types towards target counts. Targets are given per code
+# or per pattern of codes, where '?' matches any digit (e.g. '???0' is every
+# scenario of the bad distance bracket). Each draw fills the pattern with the
+# largest remaining deficit, using the code that also counts towards the
+# most other unmet targets. Issued scenarios count until they are resolved,
+# so scenarios in flight are not issued twice.
+class ScenarioSampler(object):
+    def __init__(self, targets, rng=None):
+        self.patterns = list(targets)
+        self.targets = np.array([targets[pattern] for pattern in self.patterns], dtype=np.int64)
+        self.rng = np.random.default_rng() if rng is None else rng
+        
+        # (patterns, codes) membership
+        self.matches = np.array([[self.match(pattern, code) for code in _CODES] for pattern in self.patterns], dtype=bool).reshape(-1, len(_CODES))
+        for pattern, matches in zip(self.patterns, self.matches):
+            if not matches.any():
+                raise ValueError('Invalid scenario type pattern \'%s\'' % pattern)
+                
+        self.issued = np.zeros(len(_CODES), dtype=np.int64) # Saved or in flight
+        self.saved = np.zeros(len(_CODES), dtype=np.int64)
+        
+    @staticmethod
+    def match(pattern, code):
+        return len(pattern) == len(code) and all(p == '?' or p == c for p, c in zip(pattern, code))
+        
+    # Scenarios still needed per pattern, given counts per code
+    def deficit(self, counts):
+        return self.targets - self.matches.astype(np.int64) @ counts
+        
+    # Upper bound on the scenarios needed to meet every target
+    def total(self):
+        return int(self.targets.sum())
+        
+    # Type of the next scenario to issue, or None if nothing more is needed
+    def next(self):
+        deficit = self.deficit(self.issued)
+        if deficit.max() <= 0:
+            return None
+            
+        # Pattern with the largest deficit, ties broken at random
+        order = self.rng.permutation(len(self.patterns))
+        pattern = order[np.argmax(deficit[order])]
+        
+        # Its code serving the most unmet targets, ties broken at random
+        score = np.maximum(deficit, 0) @ self.matches
+        candidates = np.flatnonzero(self.matches[pattern])
+        best = candidates[score[candidates] == score[candidates].max()]
+        code = self.rng.choice(best)
+        self.issued[code] += 1
+        return _CODES[code]
+        
+    # Outcome of an issued scenario, failed scenarios are issued again
+    def resolve(self, code, saved):
+        code = _CODES.index(code)
+        if saved:
+            self.saved[code] += 1
+        else:
+            self.issued[code] -= 1
+            
+    # Whether every target has been met by saved scenarios
+    def done(self):
+        return self.deficit(self.saved).max() <= 0
+        
+    # Saved scenarios per pattern
+    def counts(self):
+        return dict(zip(self.patterns, (self.matches.astype(np.int64) @ self.saved).tolist()))
+
+# Vehicles of each lane sorted by distance from the camera, so the nearest
+# vehicle ahead of or behind a point in a lane is a bisect. A vehicle
+# changing lane occupies both lanes. The index is re-sorted every tick, but
+# order barely changes between ticks so the sort is close to linear.
+class LaneIndex(object):
     def __init__(self):
+        self.lanes = {} # Lane -> vehicles sorted by distance
+        self.keys = {} # Lane -> their distances
+        self.occupied = {} # Vehicle -> lanes it is indexed in
+        
+    def update(self, vehicles):
+        for vehicle in vehicles:
+            lanes = {vehicle.lane, vehicle.targetLane} if vehicle.laneChange else {vehicle.lane}
+            previous = self.occupied.get(vehicle, set())
+            if lanes != previous:
+                for lane in previous - lanes:
+                    self.lanes[lane].remove(vehicle)
+                for lane in lanes - previous:
+                    self.lanes.setdefault(lane, []).append(vehicle)
+                self.occupied[vehicle] = lanes
+                
+        for lane, members in self.lanes.items():
+            members.sort(key=Vehicle.getDistance)
+            self.keys[lane] = [vehicle.getDistance() for vehicle in members]
+            
+    # Nearest vehicle in lane ahead of distance (towards -ve Z), or None
+    def ahead(self, lane, distance, exclude=None):
+        members = self.lanes.get(lane, [])
+        idx = bisect_left(self.keys.get(lane, []), distance) - 1
+        while idx >= 0 and members[idx] is exclude:
+            idx -= 1
+        return members[idx] if idx >= 0 else None
+        
+    # Nearest vehicle in lane level with or behind distance, or None
+    def behind(self, lane, distance, exclude=None):
+        members = self.lanes.get(lane, [])
+        idx = bisect_left(self.keys.get(lane, []), distance)
+        while idx < len(members) and members[idx] is exclude:
+            idx += 1
+        return members[idx] if idx < len(members) else None
+        
+
+class TrafficManager(object):
+    def __init__(self, gap=10, seed=None):
         self.speed = 0
+        self.rng = np.random.default_rng(seed)
         self.lane = 0
         self.lanes = []
-        self.vehicle = None
+        self.vehicles = [] # Overtaking vehicle first, then background traffic
+        self.index = LaneIndex()
+        self.gap = gap * _SCALE # Clear distance needed in the target lane to change lane
+        self.limit = 0 # Far end of the scenario's distance bracket
+        self.blocked = False # Lane change held back by traffic past the limit
+        
+    # The overtaking vehicle the scenario is about
+    @property
+    def vehicle(self):
+        return self.vehicles[0] if len(self.vehicles) else None
+        
+    @vehicle.setter
+    def vehicle(self, vehicle):
+        self.vehicles[:1] = [vehicle]
+        
+    def addVehicle(self, vehicle):
+        self.vehicles.append(vehicle)
+        
+    # Seed the next scenario from its place in a sharded run, so that shards
+    # are disjoint and any scenario can be regenerated on its own
+    def seed(self, run_seed, shard, index):
+        self.rng = np.random.default_rng(np.random.SeedSequence((run_seed, shard, index)))
+        
+    # Draw a new scenario, or one of type code (camera lane, start lane,
+    # target lane, distance bracket) with only the model and distance random
+    def newScenario(self, code=None):
+        model, cam_pos, car_offset, car_dest, dist_bracket, dist_offset = drawScenario(self.rng)
+        car_pos = (cam_pos + 1 + car_offset) % 3 - 1 # Any lane but the camera's
+        if code is not None:
+            cam_pos, car_pos, car_dest, dist_bracket = parseCode(code)
         
-    def newScenario(self):
         # Reset camera lane
         self.resetLane()
         
         # Reset vehicle lane (0) and position (-1M)
-        self.vehicle.radomiseModel()
+        self.vehicle.setModel(model)
         self.vehicle.laneChange = False
         self.vehicle.resetLane()
         self.vehicle.translate((0,0,-self.vehicle.getDistance()/_SCALE+1), True)
         
         # Set camera lane
-        cam_pos = np.random.randint(-1,2)
         self.setLane(cam_pos)
         self.speed = 65 # Speed constant
         
-        # Set overtaking vehicle start lane
-        while True:
-            car_pos = np.random.randint(-1,2)
-            if cam_pos != car_pos:
-                break
+        # Set overtaking vehicle start and target lane
         self.vehicle.setLane(car_pos)
-        
-        # Set overtaking vehicle target lane
-        car_dest = np.random.randint(-1,2)
         self.vehicle.targetLane = car_dest
         
         # Set overtaking distance
-        dist_bracket = np.random.randint(3)
         # Bad:(5,15) | Medium: (20,30) | Good: (35, 45)
-        dist = -((10 + dist_bracket * 15) + np.random.randint(-5,6))
+        dist = -((10 + dist_bracket * 15) + dist_offset)
         self.vehicle.setTargetDist(dist)
+        self.limit = -(15 + dist_bracket * 15) * _SCALE
+        self.blocked = False
+        
+        # Scatter background traffic, which keeps its lane and speed and
+        # passes through other vehicles
+        for vehicle in self.vehicles[1:]:
+            vehicle.radomiseModel(self.rng)
+            vehicle.laneChange = False
+            vehicle.resetLane()
+            vehicle.setLane(self.rng.integers(-1,2))
+            vehicle.targetLane = vehicle.lane
+            vehicle.translate((0,0,-vehicle.getDistance()/_SCALE + self.rng.uniform(-200,20)), True)
+            vehicle.setSpeed(self.rng.integers(55,76))
         
         return str(cam_pos+1) + str(car_pos+1) +  str(car_dest+1) + str(dist_bracket)
         
@@ -51,51 +218,243 @@ class TrafficManager(object):
         for lane in self.lanes:
             lane.translate((0,0,self.speed))
             
-
+        self.step()
+        
+    # Advance the vehicles by one frame (the traffic model without the road)
+    def step(self):
+        if len(self.vehicles) > 1:
+            self.index.update(self.vehicles)
+        for vehicle in self.vehicles:
+            self.stepVehicle(vehicle)
+            
+    def stepVehicle(self, vehicle):
         # Relative speed
-        zTransfrom = self.speed-self.vehicle.speed
+        zTransfrom = self.speed-vehicle.speed
         xTransform = 0
         
-        if self.vehicle.lane != self.vehicle.targetLane:
+        if vehicle.lane != vehicle.targetLane:
             # When not changing lane
-            if not self.vehicle.laneChange:
-                # At the target distance from camera
-                if self.vehicle.getDistance() < self.vehicle.targetDistance:
+            if not vehicle.laneChange:
+                # At the target distance from camera, with a gap in the target lane
+                if vehicle.getDistance() < vehicle.targetDistance and self.isClear(vehicle):
                     # Begin lane change
-                    self.vehicle.laneChange = True
+                    vehicle.laneChange = True
                 # Otherwise stay in lane
                 else:
                     xTransform = 0
+                    # Past the distance bracket the change would no longer
+                    # match the scenario code
+                    if vehicle is self.vehicle and vehicle.getDistance() < self.limit:
+                        self.blocked = True
             # When changing lanes
             else:
                 # If within two units (arbitrary) of target lane centre
-                if abs(self.vehicle.getRealLane() - self.vehicle.targetLane*_LANEWIDTH*_SCALE) < 2 * _SPEED:
+                if abs(vehicle.getRealLane() - vehicle.targetLane*_LANEWIDTH*_SCALE) < 2 * _SPEED:
                     # End lane change
-                    self.vehicle.laneChange = False
-                    self.vehicle.lane = self.vehicle.targetLane
+                    vehicle.laneChange = False
+                    vehicle.lane = vehicle.targetLane
                 # Otherwise continue lane change
                 else:
-                    vec = (self.vehicle.targetLane - self.vehicle.lane)
+                    vec = (vehicle.targetLane - vehicle.lane)
                     xTransform = (vec / abs(vec)) * _SPEED
                 
         
-        self.vehicle.translate((xTransform,0,zTransfrom))
+        vehicle.translate((xTransform,0,zTransfrom))
+        
+    # Whether the target lane is free within the gap ahead of and behind a vehicle
+    def isClear(self, vehicle):
+        if len(self.vehicles) == 1:
+            return True
+        distance = vehicle.getDistance()
+        for other in (self.index.ahead(vehicle.targetLane, distance, vehicle), self.index.behind(vehicle.targetLane, distance, vehicle)):
+            if other is not None and abs(other.getDistance() - distance) < self.gap:
+                return False
+        return True
         
+    # Restore a frame of a StateLog scenario, the road advances as normal
+    def replay(self, state, frame):
+        self.speed = state['speed'][frame]
+        for lane in self.lanes:
+            lane.translate((0,0,self.speed))
+            
+        self.setLane(int(state['camera_lane'][frame]))
+        self.vehicle.geometry.origin[:] = (state['x'][frame]*_SCALE, state['y'][frame]*_SCALE, state['z'][frame]*_SCALE)
+        self.vehicle.geometry.setShape((state['width'][frame], state['height'][frame], 0))
+        self.vehicle.lane = int(state['lane'][frame])
+        self.vehicle.targetLane = int(state['target_lane'][frame])
+        self.vehicle.laneChange = bool(state['lane_change'][frame])
        
     def setLane(self, lane):
         # Inverted as is OpenGL translation
-        glTranslatef(-lane*_LANEWIDTH*_SCALE, 0, 0)
         self.lane = -lane
         
     def resetLane(self):
-        # Inverted as is OpenGL translation
-        glTranslatef(-self.lane*_LANEWIDTH*_SCALE, 0, 0)
         self.lane = 0
         
+    # Camera translation applied by the renderer each frame
+    def getCamera(self):
+        return self.lane*_LANEWIDTH*_SCALE
+        
     def setSpeed(self, speed):
         self.speed = speed
         
 
+# Per-frame traffic state of many scenarios, saved column-wise (one array per
+# column in an .npz) so scenarios can be rendered later or elsewhere.
+# Positions and sizes are in metres, lanes in lane units relative to centre.
+# The (run seed, shard, index) of the first scenario is saved with them, so
+# replayed clips are named as if recorded live.
+class StateLog(object):
+    columns = dict(
+                    scenario = np.int32,
+                    frame = np.int32,
+                    x = np.float64,
+                    y = np.float64,
+                    z = np.float64,
+                    width = np.float64,
+                    height = np.float64,
+                    lane = np.int8,
+                    target_lane = np.int8,
+                    lane_change = bool,
+                    camera_lane = np.int8,
+                    speed = np.float64
+                )
+    
+    def __init__(self):
+        self.codes = []
+        self.chunks = [] # Column dicts added a batch of scenarios at a time
+        self.data = None
+        self.seed = 0 # Run seed
+        self.shard = 0
+        self.start = 0 # Index of the first scenario
+        
+    # Log whole scenarios at once, columns are (scenarios, frames) arrays
+    def extend(self, codes, columns):
+        scenarios, frames = columns['x'].shape
+        chunk = dict(
+                        scenario = np.repeat(np.arange(len(self.codes), len(self.codes) + scenarios), frames),
+                        frame = np.tile(np.arange(frames), scenarios)
+                    )
+        for name, column in columns.items():
+            chunk[name] = column.ravel()
+        self.codes.extend(codes)
+        self.chunks.append(chunk)
+                          
+    # Chunks are in scenario order, as extended
+    def save(self, path):
+        data = {name: np.concatenate([chunk[name] for chunk in self.chunks]).astype(dtype) for name, dtype in self.columns.items()}
+        # Run seeds can be 128 bit, so the seed is saved as text
+        np.savez(path, codes=np.array(self.codes), seed=str(self.seed), shard=self.shard, start=self.start, **data)
+        
+    @staticmethod
+    def load(path):
+        log = StateLog()
+        with np.load(path) as data:
+            log.codes = [str(code) for code in data['codes']]
+            log.seed = int(data['seed'])
+            log.shard = int(data['shard'])
+            log.start = int(data['start'])
+            log.data = {name: data[name] for name in StateLog.columns}
+        return log
+        
+    # Columns of one scenario of a loaded log
+    def scenario(self, index):
+        rows = slice(*np.searchsorted(self.data['scenario'], (index, index + 1)))
+        return {name: column[rows] for name, column in self.data.items()}
+        
+
+# Steps many independent scenarios at once: the state of each scenario is a
+# row of NumPy arrays and the branching of TrafficManager.step becomes masked
+# vectorised updates. Positions are in OpenGL units as for Vehicle.
+class BatchTrafficManager(object):
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.run = None # (run seed, shard, index) of the next scenario when seeded
+        self.newScenarios(0)
+        
+    # Seed the next scenarios from their place in a sharded run (as
+    # TrafficManager.seed). Each scenario is seeded by its own index, so it
+    # is the same whatever batch it is drawn in.
+    def seed(self, run_seed, shard, index):
+        self.run = (run_seed, shard, index)
+        
+    # Draws of n scenarios, one array per range of _DRAWS
+    def draw(self, n):
+        if self.run is None:
+            return [self.rng.integers(low, high, n) for low, high in _DRAWS]
+        run_seed, shard, index = self.run
+        self.run = (run_seed, shard, index + n)
+        rngs = [np.random.default_rng(np.random.SeedSequence((run_seed, shard, index + row))) for row in range(n)]
+        table = np.array([drawScenario(rng) for rng in rngs], dtype=np.int64)
+        return list(table.reshape(n, len(_DRAWS)).T)
+        
+    # Draw n scenarios in bulk (same distributions as newScenario), returns their codes
+    def newScenarios(self, n):
+        self.size = n
+        model, cam_pos, car_offset, car_dest, dist_bracket, dist_offset = self.draw(n)
+        
+        # Vehicle model
+        width = 2 + (0.01 * model)
+        height = np.round(0.6 * width, 2)
+        clear = np.round(0.75 * height, 2)
+        self.width = width * _SCALE
+        self.height = height * _SCALE
+        
+        # Camera lane, overtaking vehicle start lane (any other lane) and target lane
+        car_pos = (cam_pos + 1 + car_offset) % 3 - 1
+        
+        # Overtaking distance
+        dist = -((10 + dist_bracket * 15) + dist_offset)
+        
+        self.speed = np.full(n, 65.0)
+        self.vehicleSpeed = np.full(n, 75.0)
+        self.cameraLane = cam_pos
+        self.lane = car_pos
+        self.targetLane = car_dest
+        self.targetDistance = dist * _SCALE
+        self.laneChange = np.zeros(n, dtype=bool)
+        self.x = car_pos * _LANEWIDTH * _SCALE
+        self.y = clear * _SCALE
+        self.z = np.full(n, 1.0 * _SCALE)
+        
+        codes = np.char.add(np.char.add((cam_pos+1).astype(str), (car_pos+1).astype(str)),
+                            np.char.add((car_dest+1).astype(str), dist_bracket.astype(str)))
+        return codes.tolist()
+        
+    def step(self):
+        moving = self.lane != self.targetLane
+        
+        # At the target distance from camera begin lane change
+        begin = moving & ~self.laneChange & (self.z < self.targetDistance)
+        
+        # Within two units (arbitrary) of target lane centre end lane change,
+        # otherwise continue towards it
+        changing = moving & self.laneChange
+        arrived = changing & (np.abs(self.x - self.targetLane*_LANEWIDTH*_SCALE) < 2 * _SPEED)
+        steer = changing & ~arrived
+        xTransform = np.where(steer, np.sign(self.targetLane - self.lane) * _SPEED, 0)
+        
+        self.x += xTransform * _SPEED
+        self.z += (self.speed - self.vehicleSpeed) * _SPEED
+        self.laneChange = (self.laneChange | begin) & ~arrived
+        self.lane = np.where(arrived, self.targetLane, self.lane)
+        
+    # Current frame of every scenario as StateLog columns
+    def getState(self):
+        return dict(
+                        x = self.x / _SCALE,
+                        y = self.y / _SCALE,
+                        z = self.z / _SCALE,
+                        width = self.width / _SCALE,
+                        height = self.height / _SCALE,
+                        lane = self.lane,
+                        target_lane = self.targetLane,
+                        lane_change = self.laneChange,
+                        camera_lane = self.cameraLane,
+                        speed = self.speed
+                    )
+        
+
 
 class Vehicle(object):
     def __init__(self, colour=(0,0,1)):
@@ -113,8 +472,14 @@ class Vehicle(object):
     def drift(self):
         pass
         
-    def radomiseModel(self):
-        width = 2 + (0.01 * np.random.randint(-50,51))
+    def radomiseModel(self, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        self.setModel(rng.integers(-50,51))
+        
+    # Model of width 2 + model / 100 metres, model in [-50, 50]
+    def setModel(self, model):
+        width = 2 + (0.01 * model)
         height = np.round(0.6 * width, 2)
         clear = np.round(0.75 * height, 2)
         transform = (0, clear - (self.geometry.origin[1]/_SCALE), 0)
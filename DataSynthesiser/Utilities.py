@@ -1,25 +1,269 @@
 
-from config import _FPS
+from Encoding import *
 
 import cv2
+import fcntl
+import itertools
+import queue
 import threading
+import multiprocessing as mp
 import time
 import numpy as np
 
 from pathlib import Path
-from PIL import Image 
+from multiprocessing import shared_memory
+from concurrent.futures import Future
+
+# Append-only store of classifier samples: cropped greyscale flow masks in
+# a raw uint8 shard file and their scenario codes in a file of 4 byte
+# records. A sample is written before its code, so readers count complete
+# samples by the codes file. Each shard has a single writer, which holds a
+# lock on it. Masks of (width, height) size are squared off to
+# (height, height) samples, whose shape is kept in a .shape file.
+class SampleStore(object):
+    def __init__(self, directory, name, size=(1280,720)):
+        self.shape = SampleStore.sampleShape(size)
+        self.bar = size[0] - self.shape[1] # Width of the blank side cropped off (560 at 720p)
+        
+        # Write to the first shard of name no other writer holds with samples
+        # of this shape, so a writer restarted with the same name carries on
+        # the shard it left behind
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        for slot in itertools.count():
+            self.path = str(Path(directory) / ('samples-%s-%02d' % (name, slot)))
+            self.lock = open(self.path + '.lock', 'w')
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.lock.close()
+                continue
+            if not Path(self.path + '.shape').exists() or SampleStore.readShape(self.path) == self.shape:
+                break
+            self.lock.close()
+        with open(self.path + '.shape', 'w') as shape:
+            shape.write('%d %d\n' % self.shape)
+        
+        # Drop a sample left without a code by an interrupted writer
+        with open(self.path + '.codes', 'ab') as codes, open(self.path + '.u8', 'ab') as samples:
+            samples.truncate(codes.tell() // 4 * self.shape[0] * self.shape[1])
+        
+    # Shape of the samples of (width, height) masks
+    @staticmethod
+    def sampleShape(size):
+        return (size[1], min(size))
+        
+    @staticmethod
+    def readShape(path):
+        with open(path + '.shape') as shape:
+            return tuple(int(side) for side in shape.read().split())
+            
+    # Crop the side with no information off a (H,W) mask, as RedundancyCrop does
+    def crop(self, mask):
+        if np.any(mask[:,:self.bar]):
+            return mask[:,:self.shape[1]]
+        return mask[:,self.bar:]
+        
+    def append(self, mask, code):
+        sample = np.ascontiguousarray(self.crop(mask), dtype=np.uint8)
+        with open(self.path + '.u8', 'ab') as samples:
+            samples.write(sample.tobytes())
+        with open(self.path + '.codes', 'ab') as codes:
+            codes.write(code.encode().ljust(4)[:4])
+            
+            
+# Streams one recording to disk: each frame is encoded (see Encoding) and fed
+# to the optical flow tracker as it arrives. On close the tracked point
+# trajectories are saved as arrays alongside the rendered flow mask, which
+# goes to a SampleStore instead of a PNG when one is given.
+class Exporter(object):
+    def __init__(self, path, resolution, feature_params, lk_params, flow_colour, store=None, code=None, channels=3, encoder='ffv1'):
+        self.path = path
+        self.store = store
+        self.code = code
+        self.feature_params = feature_params
+        self.lk_params = lk_params
+        self.flow_colour = flow_colour
+        self.frames = 0
+
+        # Setup output frames, single channel frames are the blue channel alone
+        self.encoder = encoders[encoder](path, resolution, channels)
+
+        self.old_gray = None
+        self.old_pts = None
+        self.shape = None
+
+        # Per frame (points, 2) positions of each tracked point before and
+        # after that frame's flow, NaN where fewer points were tracked
+        self.origins = []
+        self.tracks = []
+
+    def write(self, frame):
+        # Write frame to video
+        self.encoder.encode(frame)
+        self.frames += 1
+
+        # Greyscale and filter G/R colour channels (RGB)
+        frame_gray = frame[:,:,2] if frame.ndim == 3 else frame
+
+        origins = np.full((self.feature_params.get('maxCorners'), 2), np.nan, dtype=np.float32)
+        tracks = origins.copy()
+
+        # Locate corners in first frame
+        if self.old_gray is None:
+            self.old_pts = cv2.goodFeaturesToTrack(frame_gray, mask = None, **self.feature_params)
+            self.shape = frame.shape
+            self.old_gray = frame_gray.copy()
+            self.origins.append(origins)
+            self.tracks.append(tracks)
+            return
+
+        old_gray, old_pts = self.old_gray, self.old_pts
+
+        # If some trackable points found
+        if old_pts is not None:
+
+            # If not max trackable points found
+            if len(old_pts) < self.feature_params.get('maxCorners'):
+                old_pts = cv2.goodFeaturesToTrack(old_gray, mask = None, **self.feature_params)
+
+            # If still some trackable points (traffic can hide the vehicle)
+            if old_pts is not None:
+
+                # Calculate optical flow
+                new_pts, status, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, old_pts, None, **self.lk_params)
+
+                # Select good points
+                good_new = new_pts[status==1]
+                good_old = old_pts[status==1]
+
+                # Record the tracks
+                origins[:len(good_old)] = good_old.reshape(-1,2)
+                tracks[:len(good_new)] = good_new.reshape(-1,2)
+
+                # Update previous points array
+                old_pts = good_new.reshape(-1,1,2)
+
+        else:
+          old_pts = cv2.goodFeaturesToTrack(old_gray, mask = None, **self.feature_params)
+
+        self.origins.append(origins)
+        self.tracks.append(tracks)
+
+        # Update the previous frame
+        self.old_gray = frame_gray.copy()
+        self.old_pts = old_pts
+
+    def close(self):
+        # Release video
+        self.encoder.finish()
+
+        # Trajectories as (frames, points, 2) arrays
+        origins = np.stack(self.origins)
+        tracks = np.stack(self.tracks)
+        np.savez_compressed(self.path + '.npz', origins=origins, tracks=tracks)
+
+        # Draw every tracked segment at once (coordinates truncated to pixels)
+        segments = np.stack((origins, tracks), axis=2).reshape(-1,2,2)
+        segments = segments[~np.isnan(segments).any(axis=(1,2))].astype(np.int32)
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        if len(segments):
+            cv2.polylines(mask, segments, False, self.flow_colour, 1)
+
+        # Write optical flow mask to disk
+        if self.store is None:
+            cv2.imwrite( self.path + '.png', mask )
+        else:
+            self.store.append(cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY) if mask.ndim == 3 else mask, self.code)
+
+    # Abandon the recording and remove partial output
+    def discard(self):
+        self.encoder.discard()
+        for ext in ('.png', '.npz'):
+            Path(self.path + ext).unlink(missing_ok=True)
+
+
+# Export loop run by each Recorder worker (thread or process). Frames arrive
+# either as arrays, or as indices of slots in shared memory which are handed
+# back on the free queue once the frame has been consumed. The outcome of
+# every recording is reported on the done queue as
+# (status, worker_id, filename, error). Given a store directory each worker
+# appends flow masks to its own shard of samples there.
+def exportWorker(worker_id, commands, done, directory, resolution, params, shm=None, free=None, store=None, shard=0, channels=3):
+    if store is not None:
+        # Recorders of other processes may share the directory and worker ids,
+        # each takes a shard of its own (see SampleStore)
+        store = SampleStore(store, '%03d-%02d' % (shard, worker_id), resolution)
+    
+    slots = None
+    if shm is not None:
+        shape = (resolution[1], resolution[0]) + ((3,) if channels == 3 else ())
+        slots = np.ndarray((shm.size // int(np.prod(shape)),) + shape, dtype=np.uint8, buffer=shm.buf)
+
+    exporter = None
+    filename = None
+    error = None
+    while True:
+        command, item = commands.get()
+
+        if command == 'exit':
+            break
+
+        try:
+            if command == 'open':
+                filename, code = item
+                print('INFO: Recorder %d: Exporting \'%s\'..' % (worker_id, filename))
+                error, exporter = None, None
+                exporter = Exporter(directory + filename, resolution, store=store, code=code, channels=channels, **params)
+            elif command == 'frame':
+                if error is None:
+                    exporter.write(item if slots is None else slots[item])
+            elif command == 'close':
+                if error is None:
+                    exporter.close()
+                    print('INFO: Recorder %d: Saved \'%s\' successfully (%d frames, %s).' % (worker_id, filename, exporter.frames, exporter.encoder.stats()))
+                    done.put(('saved', worker_id, filename, None))
+                else:
+                    done.put(('failed', worker_id, filename, error))
+            elif command == 'discard':
+                exporter.discard()
+                done.put(('discarded', worker_id, filename, None))
+        except Exception as e:
+            # Skip the rest of this recording, reported when it is closed
+            print('ERROR: Recorder %d: Failed exporting \'%s\': %s' % (worker_id, filename, e))
+            error = repr(e)
+            if exporter is not None and command != 'discard':
+                try:
+                    exporter.discard()
+                except Exception:
+                    pass
+            # A recording that fails to close is reported straight away
+            if command in ('close', 'discard'):
+                done.put(('failed', worker_id, filename, error))
+        finally:
+            if command == 'frame' and slots is not None:
+                free.put(item)
+
 
 class Recorder(object):
-    def __init__(self, resolution):
+    # resolution and channels of the frames added, (W,H,3) RGB or (W,H) blue
+    def __init__(self, resolution, workers=2, queue_size=32, backend='thread', shard=0, store=None, channels=3, encoder='ffv1'):
         self.filename = ''
         self.dir = 'data/'
+        self.shard = shard # Shard of the dataset written by this recorder
+        self.store = store # Directory of classifier samples replacing flow PNGs
         Path(self.dir).mkdir(parents=True, exist_ok=True)
-        self.workers = 2
-        self.worker_flags = [True]*self.workers
+        self.workers = workers
+        self.backend = backend
         self.resolution = resolution
-        self.frame_buffer = [] # List of frames for current recording
-        self.video_buffer = [] # Queue of videos to be rendered
-        
+        self.channels = channels
+        self.worker = None # Worker streaming the current recording
+        self.wait = 0 # Seconds the simulator has been blocked on full queues
+
+        # Completion handles of recordings not yet saved, guarded by condition
+        self.jobs = {}
+        self.load = [0]*self.workers # Unfinished recordings per worker
+        self.condition = threading.Condition()
+
         # Parameters for optical flow extraction
         # Params for ShiTomasi corner detection
         self.feature_params = dict( maxCorners = 4,
@@ -35,132 +279,126 @@ class Recorder(object):
         # Define flow plot colour
         self.flow_colour = (255,255,255)
 
-        # Threads and associated locks for rendering in background
-        self.lock = threading.Lock()
-  
-        for thread_id in range(self.workers):
-            threading.Thread(target=self.renderer, daemon=True, args=(thread_id,)).start()   
-    
-    # Add current tick frame to buffer
-    def add(self, bytes_view):
-        self.frame_buffer.append(bytes_view)
-    
-    # Stop recording
+        params = dict(feature_params=self.feature_params, lk_params=self.lk_params, flow_colour=self.flow_colour, encoder=encoder)
+
+        # Each worker streams whole recordings from its own queue and a slow
+        # encoder blocks the simulator (backpressure) rather than growing.
+        # As a recording is pinned to one worker, only the current recording
+        # and the tail of the previous one are ever exported at once: more
+        # than two workers add nothing, export scales across cores by running
+        # more simulators (see Driver), each with its own Recorder.
+        if self.workers > 2:
+            print('WARNING: Recorder: at most 2 of %d export workers are busy at once, run more simulators to use more cores.' % self.workers)
+        if self.backend == 'process':
+            # Frames are copied into a ring of shared memory slots and only the
+            # slot index is sent, so no frame is pickled between processes.
+            # The ring holds queue_size frames of each recording in flight.
+            shape = (resolution[1], resolution[0]) + ((3,) if channels == 3 else ())
+            self.shm = shared_memory.SharedMemory(create=True, size=2 * queue_size * int(np.prod(shape)))
+            self.slots = np.ndarray((2 * queue_size,) + shape, dtype=np.uint8, buffer=self.shm.buf)
+            self.free = mp.Queue()
+            for slot in range(len(self.slots)):
+                self.free.put(slot)
+            self.queues = [mp.Queue() for _ in range(self.workers)]
+            self.done = mp.Queue()
+
+            self.threads = [mp.Process(target=exportWorker, daemon=True, args=(worker_id, self.queues[worker_id], self.done, self.dir, resolution, params, self.shm, self.free, store, shard, channels)) for worker_id in range(self.workers)]
+        else:
+            self.shm = None
+            self.queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers)]
+            self.done = queue.Queue()
+
+            self.threads = [threading.Thread(target=exportWorker, daemon=True, args=(worker_id, self.queues[worker_id], self.done, self.dir, resolution, params, None, None, store, shard, channels)) for worker_id in range(self.workers)]
+
+        for thread in self.threads:
+            thread.start()
+
+        # Resolves completion handles as workers report back
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    # Hand a command to the worker of the current recording, blocking while it is full
+    def send(self, command, item=None):
+        start = time.perf_counter()
+        if command == 'frame' and self.shm is not None:
+            slot = self.free.get()
+            self.slots[slot] = item
+            item = slot
+        self.queues[self.worker].put((command, item))
+        self.wait += time.perf_counter() - start
+
+    # Add current tick frame (H,W,3 RGB array) to the stream
+    def add(self, frame):
+        self.send('frame', frame)
+
+    # Stop recording, returns a Future resolving to the saved path
     def stop(self):
         #print('INFO: Finished recording \'%s\'.' % self.filename)
-        self.video_buffer.append((self.filename, self.frame_buffer))
-        self.frame_buffer = []
-    
-    # Video Renderer (TODO: Move to new threaded class)
-    def renderer(self, thread_id):
+        # Taken before closing, as the collector drops it once saved
+        with self.condition:
+            future = self.jobs.get(self.filename)
+        self.send('close')
+        self.worker = None
+        return future
+
+    # Abandon the current recording, its handle is cancelled
+    def clear(self):
+        if self.worker is not None:
+            self.send('discard')
+            self.worker = None
+
+    def collect(self):
         while True:
-        
-            while True:
-                self.lock.acquire()
-                video_count = len(self.video_buffer)
-                self.lock.release()
-                
-                if video_count == 0:
-                    self.worker_flags[thread_id] = True
-                    time.sleep(1)
-                else:
-                    self.worker_flags[thread_id] = False
-                    break
-            
-            self.lock.acquire() 
-            
-            filename, frame_list = self.video_buffer[0]
-            del self.video_buffer[0]
-            
-            self.lock.release()
-            
-            # Delete leaked frame
-            del frame_list[0]
-            
-            print('INFO: Recorder %d: Exporting \'%s\' (%d frames)..' % (thread_id, filename, len(frame_list)))
-            
-            self.export(filename, frame_list)
-            frame_list = []
-            
-            print('INFO: Recorder %d: Saved \'%s\' successfully.' % (thread_id, filename))
-            
-    def export(self, filename, frame_list):
-    
-        # Setup output video
-        out = cv2.VideoWriter(self.dir + filename + '.avi', cv2.VideoWriter_fourcc('F','F','V','1'), _FPS, self.resolution) 
-        
-        # Locate corners in first frame
-        bytes_view = frame_list[0]
-        old_frame = np.flip(np.array(Image.frombytes("RGB", self.resolution, bytes_view)), 2)
-        old_gray = old_frame[:,:,0]
-        old_pts = cv2.goodFeaturesToTrack(old_gray, mask = None, **self.feature_params)
-        
-        # Write first frame to video
-        out.write(old_frame)
-            
-        # Create a mask image for drawing optical flow
-        mask = np.zeros_like(old_frame)
-            
-        for bytes_view in frame_list[1:]:
-            
-            # Convert from bytes view
-            frame = np.flip(np.array(Image.frombytes("RGB", self.resolution, bytes_view)), 2)
-            
-            # Write frame to video
-            out.write(frame)
-            
-            # Greyscale and filter G/R colour channels
-            frame_gray = frame[:,:,0]
-            
-            # If some trackable points found
-            if old_pts is not None:
-            
-                # If not max trackable points found
-                if len(old_pts) < self.feature_params.get('maxCorners'):
-                    old_pts = cv2.goodFeaturesToTrack(old_gray, mask = None, **self.feature_params)
-                    
-                # Calculate optical flow
-                new_pts, status, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, old_pts, None, **self.lk_params)
+            message = self.done.get()
+            if message is None:
+                break
 
-                # Select good points
-                good_new = new_pts[status==1]
-                good_old = old_pts[status==1]
+            status, worker_id, filename, error = message
+            with self.condition:
+                future = self.jobs.pop(filename)
+                self.load[worker_id] -= 1
+                self.condition.notify_all()
 
-                # Draw the tracks
-                for i,(new, old) in enumerate(zip(good_new, good_old)):
-                    a,b = new.ravel()
-                    c,d = old.ravel()
-                    # Optical flow of tracked point
-                    mask = cv2.line(mask, (a,b),(c,d), self.flow_colour, 1)
-                
-                # Update previous points array
-                old_pts = good_new.reshape(-1,1,2)
-            
+            if status == 'saved':
+                future.set_result(self.dir + filename)
+            elif status == 'discarded':
+                future.cancel()
             else:
-              old_pts = cv2.goodFeaturesToTrack(old_gray, mask = None, **self.feature_params)  
-            
-            # Update the previous frame
-            old_gray = frame_gray.copy()
-            
-        # Release video
-        out.release()
-        
-        # Write optical flow mask to disk
-        cv2.imwrite( self.dir + filename + '.png', mask )
-        
-    def clear(self):
-        self.frame_buffer = []
-        
-    def openNew(self, scenario):
-        p = Path(self.dir + '/').glob('scen_' + scenario + '-*.avi')
-        n_entries = len([x for x in p if x.is_file()])
-        filenumber = str(n_entries).zfill(6)
-        self.filename = 'scen_' + scenario + '-' + filenumber
-        open(self.dir + self.filename + '.avi',"w+")
-        open(self.dir + self.filename + '.png',"w+")
-        
+                future.set_exception(RuntimeError('Failed exporting \'%s\': %s' % (filename, error)))
+
+    # Names are unique to the (run seed, shard, index) of the scenario, so
+    # shards and runs can be recorded into the same directory without
+    # checking it, and a clip can be regenerated from its name
+    def openNew(self, scenario, seed, shard, index):
+        self.filename = 'scen_%s-%d-%03d-%06d' % (scenario, seed, shard, index)
+
+        # Stream to the least busy worker
+        with self.condition:
+            self.worker = self.load.index(min(self.load))
+            self.load[self.worker] += 1
+            future = self.jobs[self.filename] = Future()
+        self.send('open', (self.filename, scenario))
+        return future
+
     def isRecording(self):
-        if self.frame_buffer == [] and self.video_buffer == [] and all(self.worker_flags):
-            return False
-        else:
-            return True
+        with self.condition:
+            return self.worker is not None or len(self.jobs) > 0
+
+    # Block until every stopped recording has been saved
+    def join(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.jobs) == 0, timeout)
+
+    # Stop the workers and release shared memory, once recording has finished
+    def close(self):
+        for commands in self.queues:
+            commands.put(('exit', None))
+        for thread in self.threads:
+            thread.join()
+        self.done.put(None)
+        self.collector.join()
+
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
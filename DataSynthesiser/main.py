@@ -14,12 +14,14 @@ from config import _LANEWIDTH
 
 from Geometry import *
 from TrafficManagement import *
+from Rendering import *
 from Utilities import *
 
 import matplotlib.pyplot as plt
 from PIL import Image 
 
 import time
+import argparse
 
 
 
@@ -33,53 +35,155 @@ import time
  # V Y-axis (Towards -ve Y)
  
 class Simulator(object):
-    def __init__(self, fovy=78, resolution=(1280,720)):
-        self.resolution = resolution
+    def __init__(self, fovy=78, resolution=(1280,720), headless=False, readback='async', workers=2, queue_size=32, backend='thread', seed=None, shard=0, index=0, store=None, profile=None, encoder='ffv1'):
+        # Frames produced are the profile's window and channels of a resolution render
+        self.profile = profile if profile is not None else RenderProfile(resolution)
+        self.profile.check()
+        self.resolution = self.profile.resolution
         # 78 fovy gives ~140fovx at 720p resolution (average for many dashcams)
         self.fovy = fovy
-        self.geometry = []
+        self.headless = headless
+        self.scene = Scene()
         self.tm = TrafficManager()
         #self.fm = FileManager()
-        self.recorder = Recorder(resolution)
         self.running = True
+        self.frames = 25 * _FPS + 1 # Frames per scenario
         
-        # Start pygame window and configure perspective
-        pygame.init()
-        self.window = pygame.display.set_mode(self.resolution, DOUBLEBUF|OPENGL|NOFRAME)
-        gluPerspective(fovy, (self.resolution[0]/self.resolution[1]), 0.1*_SCALE, 200*_SCALE)
-        glTranslatef(0, -1.2*_SCALE, 0)
+        # Scenario index of a shard of a seeded run, a random run seed is
+        # reported so the run can be reproduced
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+            print('INFO: Run seed: %d' % seed)
+        self.seed = seed
+        self.shard = shard
+        self.index = index
+        self.recorder = Recorder(self.profile.size(), workers, queue_size, backend, shard, store, self.profile.channels, encoder)
         
+        # Headless renders in software, with no window, vsync or event loop
+        if self.headless:
+            self.renderer = SoftwareRenderer(self.profile, fovy)
+        else:
+            self.renderer = WindowRenderer(self.profile, fovy, readback)
         
-    def run(self):
+        
+    def run(self, scenarios=None):
+        self.renderer.load(self.scene)
         while self.running:
-            scenario = self.tm.newScenario()
-            self.recorder.openNew(scenario)
-            print('INFO: Simulating scenario type: %s' % scenario)
-            for frame in range(25 * _FPS + 1):
-                glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+            try:
+                self.runScenario()
+            except RuntimeError as e:
+                print('WARNING: Scenario %d discarded: %s' % (self.index - 1, e))
+                continue
+            
+            # Headless runs stop after a fixed number of scenarios
+            if scenarios is not None:
+                scenarios -= 1
+                if scenarios <= 0:
+                    self.running = False
+                    
+    # Render and record the scenario at the current index (of type code if
+    # given), returns its code and completion handle. Raises RuntimeError,
+    # with the recording discarded, if traffic blocks its lane change.
+    def runScenario(self, code=None):
+        self.tm.seed(self.seed, self.shard, self.index)
+        code = self.tm.newScenario(code)
+        try:
+            future = self.record(code, self.step, (self.seed, self.shard, self.index))
+        finally:
+            self.index += 1
+        return code, future
+        
+    # Advance a drawn scenario by one frame
+    def step(self, frame):
+        self.tm.update()
+        if self.tm.blocked:
+            raise RuntimeError('Lane change blocked by traffic past its distance bracket')
+        
+    # Run the traffic model only, logging every frame's state without rendering.
+    # Scenarios are stepped in batches of up to batch at once, each seeded by
+    # its own index so the log does not depend on batch.
+    def simulate(self, scenarios, path, batch=1024):
+        log = StateLog()
+        log.seed, log.shard, log.start = self.seed, self.shard, self.index
+        btm = BatchTrafficManager()
+        start = time.perf_counter()
+        for first in range(0, scenarios, batch):
+            btm.seed(self.seed, self.shard, self.index + first)
+            codes = btm.newScenarios(min(batch, scenarios - first))
+            columns = {}
+            for frame in range(self.frames):
+                btm.step()
+                for name, column in btm.getState().items():
+                    if name not in columns:
+                        columns[name] = np.empty((btm.size, self.frames), dtype=column.dtype)
+                    columns[name][:,frame] = column
+            log.extend(codes, columns)
+        log.save(path)
+        print('INFO: Simulated %d scenarios (%.0f scenarios/s), saved \'%s\'' % (scenarios, scenarios / (time.perf_counter() - start), path))
+        
+    # Render the scenarios of a state log written by simulate, named by the
+    # run seed, shard and index they were simulated with
+    def replay(self, path):
+        log = StateLog.load(path)
+        self.renderer.load(self.scene)
+        for scenario, code in enumerate(log.codes):
+            state = log.scenario(scenario)
+            self.record(code, lambda frame: self.tm.replay(state, frame), (log.seed, log.shard, log.start + scenario))
+            if not self.running:
+                break
+            
+    # Render and record one scenario, step(frame) advances the traffic state
+    # and clip is the (run seed, shard, index) it is named by
+    def record(self, scenario, step, clip):
+        self.recorder.openNew(scenario, *clip)
+        print('INFO: Simulating scenario type: %s' % scenario)
+        stall = 0
+        wait = self.recorder.wait
+        try:
+            for frame in range(self.frames):
+                step(frame)
                 
-                self.tm.update()
+                self.renderer.setCamera(self.tm.getCamera())
+                self.renderer.clear()
+                self.renderer.draw()
                 
-                for geometry in self.geometry:
-                    geometry.render()
-                    
-                pygame.display.flip()
-
-                self.recorder.add(pygame.image.tostring(self.window, "RGB"))
+                # Time the render loop spends blocked on readback
+                start = time.perf_counter()
+                image = self.renderer.read()
+                stall += time.perf_counter() - start
+                
+                if image is not None:
+                    self.recorder.add(image)
+                self.renderer.flip()
                 self.checkExit()
-            
-            self.recorder.stop() 
-            
+        except Exception:
+            # Abandon the recording along with frames still in flight
+            self.renderer.flush()
+            self.recorder.clear()
+            raise
         
-    def exit(self):
-        pygame.quit()
+        for image in self.renderer.flush():
+            self.recorder.add(image)
+        future = self.recorder.stop() 
+        print('INFO: Readback stall: %.3f ms/frame' % (1000 * stall / self.frames))
+        print('INFO: Recorder backpressure: %.3f ms/frame' % (1000 * (self.recorder.wait - wait) / self.frames))
+        return future
+        
+    # Finish saving recordings and release the renderer and recorder
+    def close(self):
+        self.renderer.close()
         print('WARNING: Please wait! Render in progress..')
-        while self.recorder.isRecording():
-            time.sleep(5)
+        self.recorder.join()
+        self.recorder.close()
+        
+    def exit(self):
+        self.close()
         print('INFO: Simulation terminated.')
         quit()
                   
     def checkExit(self):
+        if self.headless:
+            return
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 print('INFO: Preparing to quit... ')
@@ -87,22 +191,20 @@ class Simulator(object):
                 
                 
     def addStaticGeometry(self, geometry):
-        self.geometry.append(geometry)
+        self.scene.add(geometry)
         
     def addLane(self, lane):
         self.tm.lanes.append(lane)
-        self.geometry.append(lane)
+        self.scene.add(lane)
         
+    # The first vehicle added overtakes, the rest are background traffic
     def addVehicle(self, vehicle):
-        self.tm.vehicle = vehicle
-        self.geometry.append(vehicle.geometry)
+        self.tm.addVehicle(vehicle)
+        self.scene.add(vehicle.geometry)
     
-        
-
-if __name__ == '__main__':  
-
-    simulator = Simulator()
     
+# Motorway with three lanes, an overtaking vehicle and background traffic
+def buildScene(simulator, traffic=0):
     # Add edges of motorway
     simulator.addStaticGeometry(Cube(origin=(-1.5*_LANEWIDTH,0,-100), shape=(0.15,0,200)))
     simulator.addStaticGeometry(Cube(origin=(1.5*_LANEWIDTH,0,-100), shape=(0.15,0,200)))
@@ -117,7 +219,41 @@ if __name__ == '__main__':
     # Add vehicles
     simulator.addVehicle(Vehicle())
     
-    simulator.run()
+    # Background traffic has no blue, so optical flow only tracks the overtaking vehicle
+    for _ in range(traffic):
+        simulator.addVehicle(Vehicle(colour=(1,1,0)))
+        
+
+if __name__ == '__main__':  
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--headless', action='store_true', help='render in software without a window')
+    parser.add_argument('--scenarios', type=int, default=None, help='number of scenarios to simulate')
+    parser.add_argument('--readback', choices=['async', 'sync'], default='async', help='window pixel readback mode')
+    parser.add_argument('--workers', type=int, default=2, help='recorder export workers (two overlap consecutive recordings, run Driver.py to use more cores)')
+    parser.add_argument('--queue-size', type=int, default=32, help='frames buffered per recorder worker before the simulator blocks')
+    parser.add_argument('--backend', choices=['thread', 'process'], default='thread', help='recorder export workers as threads or processes')
+    parser.add_argument('--simulate-only', metavar='PATH', default=None, help='log scenario states to PATH without rendering')
+    parser.add_argument('--replay', metavar='PATH', default=None, help='render the scenarios of a state log')
+    parser.add_argument('--traffic', type=int, default=0, help='number of background traffic vehicles')
+    parser.add_argument('--seed', type=int, default=None, help='run seed shared by every shard of a dataset (random if not given)')
+    parser.add_argument('--shard', type=int, default=0, help='shard of the dataset generated by this process')
+    parser.add_argument('--start', type=int, default=0, help='index of the first scenario in the shard')
+    parser.add_argument('--profile', choices=sorted(profiles), default='full', help='render profile (resolution and channels)')
+    parser.add_argument('--encoder', choices=sorted(encoders), default='ffv1', help='frame encoder: none (flow only), ffv1 video, npy raw stack or npz compressed chunks')
+    parser.add_argument('--store', metavar='DIR', default=None, help='append cropped flow masks to a classifier sample store instead of writing PNGs')
+    args = parser.parse_args()
+
+    simulator = Simulator(profile=profiles[args.profile], headless=args.headless or args.simulate_only is not None, readback=args.readback, workers=args.workers, queue_size=args.queue_size, backend=args.backend,
+                          seed=args.seed, shard=args.shard, index=args.start, store=args.store, encoder=args.encoder)
+    buildScene(simulator, args.traffic)
+    
+    if args.simulate_only is not None:
+        simulator.simulate(args.scenarios or 1, args.simulate_only)
+    elif args.replay is not None:
+        simulator.replay(args.replay)
+    else:
+        simulator.run(args.scenarios)
     simulator.exit()
     
     
\ No newline at end of file
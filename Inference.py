@@ -0,0 +1,123 @@
+"""Batch inference for networks trained by Classifier.py.
+
+Loads a saved state_dict (.pth) or TorchScript model (.pt), optionally
+quantises the fully connected layers to int8 and exports TorchScript, then
+classifies flow images in large batches and reports throughput.
+
+Usage:
+    python Inference.py default.pth data/ --quantise --export default.pt
+    find data -name '*.png' | python Inference.py default.pt - > labels.csv
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import torch.nn as nn
+import torch as T
+
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+
+from Network import RedundancyCrop, Network
+
+class ImageFiles(Dataset):
+    """Flow images by path, preprocessed as for training.
+    Args:
+        paths (list): Image paths.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.transform = transforms.Compose([transforms.Grayscale(), RedundancyCrop(), transforms.ToTensor()])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        with Image.open(self.paths[idx]) as img:
+            return self.transform(img.convert('RGB'))
+
+def loadModel(path, quantise=False, script=False, **options):
+    """Loads a trained network for CPU inference.
+    Args:
+        path (str): state_dict saved by Classifier.saveModel, or a
+            TorchScript model saved by this module (.pt).
+        quantise (bool): Dynamically quantise fc1/fc2 to int8, which hold
+            nearly all of the weights.
+        script (bool): Trace to TorchScript.
+        options: Network configuration the state_dict was trained with.
+    Returns:
+        nn.Module: Network in eval mode.
+    Raises:
+        ValueError: If quantise is set for a TorchScript model, which is
+            loaded as it was exported.
+    """
+    if path.endswith('.pt'):
+        if quantise:
+            raise ValueError('Cannot quantise TorchScript model \'%s\', quantise the .pth state_dict when exporting it' % path)
+        return T.jit.load(path, map_location='cpu').eval()
+
+    network = Network(**options)
+    network.load_state_dict(T.load(path, map_location='cpu'))
+    network.eval()
+
+    if quantise:
+        network = T.ao.quantization.quantize_dynamic(network, {nn.Linear}, dtype=T.qint8)
+    if script:
+        with T.no_grad():
+            network = T.jit.freeze(T.jit.trace(network, T.zeros(1, 1, 720, 720)))
+    return network
+
+def classify(network, paths, batch_size=64, workers=2):
+    """Classifies images in batches.
+    Returns:
+        list: Predicted label of each path.
+    """
+    loader = DataLoader(ImageFiles(paths), batch_size=batch_size, num_workers=workers)
+    labels = []
+    with T.inference_mode():
+        for batch in loader:
+            labels.extend(network(batch).argmax(1).tolist())
+    return labels
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='state_dict (.pth) or TorchScript model (.pt)')
+    parser.add_argument('images', help='directory searched for .png images, or - to read paths from stdin')
+    parser.add_argument('--quantise', action='store_true', help='int8 dynamic quantisation of the fully connected layers')
+    parser.add_argument('--export', metavar='PATH', default=None, help='save the model as TorchScript')
+    parser.add_argument('--batch-size', type=int, default=64, help='images per batch')
+    parser.add_argument('--workers', type=int, default=2, help='image decoding workers')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads')
+    parser.add_argument('--hidden', type=int, default=4096, help='network fc1 width')
+    parser.add_argument('--outputs', type=int, default=2048, help='network fc2 width')
+    parser.add_argument('--channels-last', action='store_true', help='run the convolutions in NHWC layout')
+    args = parser.parse_args()
+    if args.quantise and args.model.endswith('.pt'):
+        parser.error('--quantise applies to .pth state_dicts, TorchScript models are loaded as exported')
+
+    if args.threads is not None:
+        T.set_num_threads(args.threads)
+
+    network = loadModel(args.model, args.quantise, args.export is not None, hidden=args.hidden, outputs=args.outputs, channels_last=args.channels_last)
+    if args.export is not None:
+        network.save(args.export)
+        print('Saved TorchScript model \'%s\'' % args.export, file=sys.stderr)
+
+    if args.images == '-':
+        paths = [line.strip() for line in sys.stdin if line.strip()]
+    else:
+        paths = sorted(glob.glob(os.path.join(args.images, '**', '*.png'), recursive=True))
+
+    start = time.perf_counter()
+    labels = classify(network, paths, args.batch_size, args.workers)
+    elapsed = time.perf_counter() - start
+
+    for path, label in zip(paths, labels):
+        print('%s,%d' % (path, label))
+    print('Classified %d images in %.2fs (%.1f images/s)' % (len(paths), elapsed, len(paths) / elapsed if elapsed else 0), file=sys.stderr)
@@ -0,0 +1,176 @@
+"""Network and preprocessing shared by Classifier.py and Inference.py.
+
+Run on its own to benchmark CPU training throughput of network options
+against the original network:
+    python Network.py
+"""
+
+import time
+import numpy as np
+from PIL import Image
+
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.nn as nn
+import torch as T
+
+class RedundancyCrop(object):
+    """Squares off a 1280x720p image by cropping the side of 
+        the image that contains no information. Works on single PIL
+        images, or on whole (N, ..., 720, 1280) uint8 tensor batches where
+        the side of each image can be detected once and passed back in.
+        Images with nothing in the left bar keep the right side, so a
+        blank image is cropped rather than dropped.
+    Args:
+        stride (int): Spacing of the bar columns sampled before the whole
+            bar is checked.
+    """
+    bar = 560 # Width of the bar cropped off
+    width = 720 # Width kept
+
+    def __init__(self, stride=8):
+        self.stride = stride
+
+    def __call__(self, img):
+        """
+        Args:
+            img (PIL Image): Image to be cropped.
+        Returns:
+            PIL Image: Cropped image.
+        """
+        np_img = np.array(img)
+        l_bbar = np_img[:,:self.bar]
+
+        # Sampled columns usually hit a drawn track, the whole bar only
+        # needs checking when they don't
+        if np.any(l_bbar[:,::self.stride]) or np.any(l_bbar):
+          return Image.fromarray(np_img[:,:self.width])
+        return Image.fromarray(np_img[:,self.bar:])
+
+    def detect(self, batch):
+        """
+        Args:
+            batch (Tensor): (N, ..., H, W) images.
+        Returns:
+            Tensor: (N,) bool, True where the left side is kept.
+        """
+        bars = batch[..., :self.bar]
+        left = bars[..., ::self.stride].flatten(1).amax(1) > 0
+        rest = ~left
+        if rest.any():
+            left[rest] = bars[rest].flatten(1).amax(1) > 0
+        return left
+
+    def crop(self, batch, left=None):
+        """
+        Args:
+            batch (Tensor): (N, ..., H, W) images.
+            left (Tensor): Sides from detect, detected if not given.
+        Returns:
+            Tensor: (N, ..., H, 720) cropped images.
+        """
+        if left is None:
+            left = self.detect(batch)
+        left = left.view((-1,) + (1,) * (batch.dim() - 1))
+        return T.where(left, batch[..., :self.width], batch[..., self.bar:])
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class Network(nn.Module):
+    """Flow mask classifier for 720x720 greyscale inputs.
+    Args:
+        hidden (int): Width of the first fully connected layer.
+        outputs (int): Width of the output layer. The defaults are the
+            original 4096 -> 2048 head, hidden=256, outputs=2 is a small
+            head for the two classes at a fraction of the cost.
+        channels_last (bool): Run the convolutions in NHWC memory format,
+            usually faster on CPU.
+        norm_affine (bool): Learn a scale and shift in the normalisation
+            (4x357x357 each). Off matches the original untrained LayerNorm.
+    """
+    def __init__(self, hidden=4096, outputs=2048, channels_last=False, norm_affine=False):
+        super(Network, self).__init__()
+        self.channels_last = channels_last
+        self.conv1 = nn.Conv2d(1, 4, kernel_size=7, stride=2)
+        self.norm1 = nn.LayerNorm((4, 357, 357), elementwise_affine=norm_affine)
+        self.pool1 = nn.MaxPool2d(2, 2)
+        self.conv2 = nn.Conv2d(4, 4, kernel_size=5, stride=2)
+        self.pool2 = nn.MaxPool2d(2, 2)
+        self.conv3 = nn.Conv2d(4, 4, kernel_size=3, stride=1)
+        self.conv4 = nn.Conv2d(4, 4, kernel_size=3, stride=1)
+        self.conv5 = nn.Conv2d(4, 4, kernel_size=3, stride=1)
+        self.pool5 = nn.MaxPool2d(2, 2)
+        self.fc1 = nn.Linear(4 * 18 * 18, hidden)
+        self.fc2 = nn.Linear(hidden, outputs)
+
+        if self.channels_last:
+            self.to(memory_format=T.channels_last)
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=T.channels_last)
+        x = F.relu(self.conv1(x))
+        x = self.norm1(x)
+        x = self.pool1(x)
+        x = self.pool2(F.relu(self.conv2(x)))
+        x = F.relu(self.conv3(x))
+        x = F.relu(self.conv4(x))
+        x = self.pool5(F.relu(self.conv5(x)))
+        x = T.flatten(x, 1)
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        return x
+
+class OriginalNetwork(Network):
+    """Network as first written, building a new LayerNorm on every forward
+        pass, kept as the baseline of the benchmark.
+    """
+    def forward(self, x):
+        x = F.relu(self.conv1(x))
+        x = nn.LayerNorm(x.size()[1:])(x)
+        x = self.pool1(x)
+        x = self.pool2(F.relu(self.conv2(x)))
+        x = F.relu(self.conv3(x))
+        x = F.relu(self.conv4(x))
+        x = self.pool5(F.relu(self.conv5(x)))
+        x = x.view(-1, 4 * 18 * 18)
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        return x
+
+def benchmark(network, batch_size=16, batches=10, train=True):
+    """Measures CPU throughput of a network on random 720x720 inputs.
+    Args:
+        network (Network): Network to time.
+        batch_size (int): Samples per batch.
+        batches (int): Batches timed, after one warm up batch.
+        train (bool): Time training steps (SGD) rather than inference.
+    Returns:
+        float: Samples per second.
+    """
+    inputs = T.rand(batch_size, 1, 720, 720)
+    labels = T.randint(0, 2, (batch_size,))
+    criterion = nn.CrossEntropyLoss()
+    optimiser = optim.SGD(network.parameters(), lr=0.001, momentum=0.9)
+    network.train(train)
+
+    for idx in range(batches + 1):
+        if idx == 1:
+            start = time.perf_counter()
+        if train:
+            optimiser.zero_grad()
+            loss = criterion(network(inputs), labels)
+            loss.backward()
+            optimiser.step()
+        else:
+            with T.no_grad():
+                network(inputs)
+
+    return batch_size * batches / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+
+    print('original: %.1f samples/s' % benchmark(OriginalNetwork()))
+    for options in (dict(), dict(channels_last=True), dict(hidden=256, outputs=2), dict(hidden=256, outputs=2, channels_last=True)):
+        print('%s: %.1f samples/s' % (options, benchmark(Network(**options))))